@@ -2,7 +2,10 @@
 import pandas as pd
 from scipy.stats import gaussian_kde
 import numpy as np
-import networkx as nx
+from dp_sequential_events.main.dafsa import DAFSA
+from dp_sequential_events.main.event_log import read_log
+from dp_sequential_events.main.kde import GRID_SIZE, estimate_pk_table, metric_values, refit_state
+from dp_sequential_events.main.variants import VariantIndex
 
 # Functions
 def normalize_rt(group):
@@ -15,74 +18,17 @@ def normalize_rt(group):
         group["NrmRelTime"] = ((group["RelTime"] - min_t) / (max_t - min_t))
     return group
 
-def precision(group):        
-    r = group["RelTime"].max() - group["RelTime"].min()
+def precision(rel_time, min_rt, max_rt):
+    # Element-wise over the table, min_rt and max_rt being the group-wise transforms
+    r = max_rt - min_rt
+    precision_real = np.where(rel_time == min_rt, 1.0, 10/60)
+    p_norm = precision_real / np.where(r == 0, 1, r)
 
-    if r == 0:
-        return pd.Series(np.full(len(group), 0.01), index=group.index)
-    
-    p_vals = []
-    for rt in group["RelTime"]:
-        if rt == group["RelTime"].min():
-            precision_real = 1.0  
-        else:
-            precision_real = 10/60  
-
-        p_norm = precision_real / r
-
-        p_vals.append(p_norm)
-    return pd.Series(p_vals, index=group.index)
+    return np.where(r == 0, 0.01, p_norm)
 
 def build_dafsa_graph(unique_seqs):
-    G = nx.MultiDiGraph()
-    G.add_node(0)
-    node_counter = 1
-    
-    for seq in unique_seqs:
-        current = 0
-        for act in seq:
-            next_node = None
-            for nbr in G.successors(current):
-                for key, data in G[current][nbr].items():
-                    if data.get('label') == act:
-                        next_node = nbr
-                        break
-                if next_node is not None:
-                    break
-            
-            if next_node is None:
-                G.add_node(node_counter)
-                G.add_edge(current, node_counter, label=act)
-                current = node_counter
-                node_counter += 1
-            else:
-                current = next_node
-
-    changed = True
-    while changed:
-        changed = False
-        nodes = list(G.nodes())
-        for i in range(len(nodes)):
-            for j in range(i + 1, len(nodes)):
-                n1 = nodes[i]
-                n2 = nodes[j]
-                if n1 not in G or n2 not in G:
-                    continue
-                
-                edges1 = sorted([(data['label'], nbr) for nbr in G.successors(n1) for key, data in G[n1][nbr].items()])
-                edges2 = sorted([(data['label'], nbr) for nbr in G.successors(n2) for key, data in G[n2][nbr].items()])
-                
-                if edges1 == edges2:
-                    incoming = list(G.predecessors(n2))
-                    for pred in incoming:
-                        for key, data in list(G[pred][n2].items()):
-                            G.add_edge(pred, n1, label=data['label'])
-                    G.remove_node(n2)
-                    changed = True
-                    break
-            if changed:
-                break
-    return G
+    # networkx view of the DAFSA, only needed to render the automaton
+    return DAFSA.from_sequences(unique_seqs).to_networkx()
 
 def estimate_pk(group, delta=0.3, name="PK"):
     t = group["NrmRelTime"].values
@@ -122,80 +68,64 @@ def estimate_pk(group, delta=0.3, name="PK"):
     return group
 
 # Main function to create annotated table
-def DAFSA_annotated_table(nombre_archivo="../databases/datos_sinteticos.csv"):
+def DAFSA_annotated_table(nombre_archivo="../databases/datos_sinteticos.csv", grid_size=GRID_SIZE, read_options=None, workers=1, metrics=True):
+    # With metrics=False the table stops at the DAFSA states (no NrmRelTime, Prec, PK
+    # or pk_refit), for callers that compute them over parts of the log themselves
     # 1. Load and preprocess the event log
-    log = pd.read_csv(nombre_archivo, parse_dates=["Timestamp"])
+    log = read_log(nombre_archivo, read_options)
     log = log.sort_values(["CaseID", "Timestamp"]).reset_index(drop=True) # Sort logs
 
-    # 2. Extract sequences from the log
-    grouped = log.groupby("CaseID")
-    sequences = grouped["Activity"].apply(lambda x: x.astype(str).tolist()).to_dict()
-
-    sequences = {k: ["START"] + v for k, v in sequences.items()}
+    # 2. Integer-coded variants, shared with the later stages. Cases and activities
+    # are kept as categoricals, their labels are only materialized on export.
+    log["CaseID"] = log["CaseID"].astype("category")
+    index = VariantIndex.from_log(log)
+    variants = index.sequences()
 
     # 3. Create DAFSA from sequences
-    unique_seqs = list(set(tuple(seq) for seq in sequences.values()))
-    unique_seqs.sort() 
-    
-    graph = build_dafsa_graph(unique_seqs)
-
-    # State map 
-    state_map = {state: i for i, state in enumerate(graph.nodes())}
-
-    # 4. Find start state (root)
-    targets = {v for _, v in graph.edges()}
-    candidates = [n for n in graph.nodes() if n not in targets]
-
-    if len(candidates) == 0:
-        raise ValueError("No root state found.")
-
-    start = candidates[0]
-
-    def next_state(G, current, act):
-        for nbr in G.successors(current):
-            for key, data in G[current][nbr].items():
-                if data.get("label") == act:
-                    return nbr
-        raise ValueError(f"No transition from {current} with {act}")
-
-    # 6. Build DAFSA-annotated table
-    rows = []
-
-    for case_id, group in grouped:
-        group = group.sort_values("Timestamp").reset_index(drop=True)
-        acts = group["Activity"].tolist()
-        times = group["Timestamp"].tolist()
-
-        current = start
-
-        tgt = next_state(graph, current, "START")
-        current = tgt
-
-        tgt = next_state(graph, current, acts[0])
-        t0 = log["Timestamp"].min()
-        first_rel = (times[0] - t0).total_seconds() / 86400  # en días
-        rows.append([case_id, acts[0], times[0], state_map[current], state_map[tgt], first_rel])
-        current = tgt
-
-        for i in range(1, len(acts)):
-            act = acts[i]
-            tgt = next_state(graph, current, act)
-
-            rel = (times[i] - times[i-1]).total_seconds() / 60 # in minutes
-
-            rows.append([case_id, act, times[i], state_map[current], state_map[tgt], rel])
-            current = tgt
-
-    df = pd.DataFrame(rows, columns=[
-        "CaseID", "Activity", "Timestamp", "SrcState", "TgtState", "RelTime"
-    ])
+    unique_seqs = sorted(("START",) + seq for seq in variants)
+
+    dafsa = DAFSA.from_sequences(unique_seqs)
+
+    # 4. Walk each variant once. States after START are laid out back to back, so a
+    # variant's transitions are path[offset + i] -> path[offset + i + 1].
+    after_start = dafsa.next_state(dafsa.start, dafsa.encode(["START"])[0])
+    to_dafsa = dafsa.encode(index.activities)
+    paths = [dafsa.walk(to_dafsa[index.sequence_codes(v)], start=after_start) for v in range(index.n_variants)]
+    path_offsets = np.concatenate([[0], np.cumsum([len(p) for p in paths])[:-1]])
+    paths = np.concatenate(paths)
+
+    # 5. Broadcast the variant paths to the events through the variant of their case
+    pos = path_offsets[index.event_variant()] + index.event_step()
+
+    # 6. Build DAFSA-annotated table. The first event of a case is measured in days
+    # from the log start, the following ones in minutes from the previous event.
+    ns = log["Timestamp"].values.view(np.int64)
+    first = index.offsets[:-1]
+    rel = np.empty(len(ns))
+    rel[1:] = np.diff(ns) / 60e9
+    rel[first] = (ns[first] - ns.min()) / 86400e9
+
+    df = pd.DataFrame({
+        "CaseID": log["CaseID"],
+        "Activity": log["Activity"],
+        "Timestamp": log["Timestamp"],
+        "SrcState": paths[pos],
+        "TgtState": paths[pos + 1],
+        "RelTime": rel,
+    })
+
+    if not metrics:
+        df["RelTime"] = df["RelTime"].round(2)
+        df.attrs["variant_index"] = index
+        df.attrs["dafsa"] = dafsa
+        return df
 
     group_cols = ["SrcState", "Activity", "TgtState"]
 
     # 6. Normalized relative time
     #df = df.groupby(group_cols, group_keys=False).apply(normalize_rt).reset_index(drop=True)
-    min_rt = df.groupby(group_cols)["RelTime"].transform("min")
-    max_rt = df.groupby(group_cols)["RelTime"].transform("max")
+    min_rt = df.groupby(group_cols, observed=True)["RelTime"].transform("min")
+    max_rt = df.groupby(group_cols, observed=True)["RelTime"].transform("max")
 
     range_rt = max_rt - min_rt
 
@@ -206,17 +136,22 @@ def DAFSA_annotated_table(nombre_archivo="../databases/datos_sinteticos.csv"):
     )
     
     # 7. Precision
-    df["Prec"] = df.groupby(group_cols).apply(precision).values
+    df["Prec"] = precision(df["RelTime"].values, min_rt.values, max_rt.values)
 
     # 8. Prior Knowledge PK
-    df["PK"] = (
-        df.groupby(group_cols)
-        .apply(lambda g: estimate_pk(g)["PK"])
-        .values
-    )
+    df["PK"] = estimate_pk_table(df, group_cols, grid_size=grid_size, workers=workers)
+
+    # Round numeric columns. The derived metrics are stored as float32, RelTime stays
+    # float64 since the timestamps are rebuilt from it and float32 cannot hold two
+    # decimals of gaps above ~45 days.
+    df["RelTime"] = df["RelTime"].round(2)
+    metric_cols = ["NrmRelTime", "Prec", "PK"]
+    df[metric_cols] = df[metric_cols].round(2).astype(np.float32)
 
-    # Round numeric columns 
-    numeric_cols = df.select_dtypes(include=[np.number]).columns
-    df[numeric_cols] = df[numeric_cols].round(2)
+    df.attrs["variant_index"] = index
+    df.attrs["dafsa"] = dafsa
 
+    # 9. KDE of every group over the rounded NrmRelTime. Filtering fits New PK on the
+    # rounded columns, so the groups that lose no events take it from here.
+    df.attrs["pk_refit"] = refit_state(metric_values(df, "NrmRelTime"), dafsa.table_edges(df), dafsa.n_transitions, grid_size)
     return df
\ No newline at end of file
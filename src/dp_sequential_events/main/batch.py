@@ -0,0 +1,384 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import pandas as pd
+
+from dp_sequential_events.main.annotated import DAFSA_annotated_table
+from dp_sequential_events.main.cache import CACHE_DIR, AnnotationCache
+from dp_sequential_events.main.event_log import FORMATS, LOG_COLUMNS, LOG_FORMATS, XES_COLUMNS, ReadOptions, log_format, read_columns, read_table, write_table
+from dp_sequential_events.main.filtered import DAFSA_filtrated
+from dp_sequential_events.main.incremental import DAFSA_append
+from dp_sequential_events.main.main import main, write_anonymized
+from dp_sequential_events.main.randomness import RandomStreams
+from dp_sequential_events.main.windows import windowed_releases
+
+# "privseq run": the full pipeline without prompts, for schedulers. Settings come from
+# a TOML or JSON config and/or flags (flags win), every input log is anonymized in its
+# own task of a process pool and written to the output folder, and a JSON summary
+# records the timings and removed cases of every log. With a window, every log is
+# annotated once and released per time window instead, the windows of a log in
+# parallel.
+
+RUN_DEFAULTS = {
+    "input": [],
+    "delta": 0.3,
+    "condition_number": 1.0,
+    "months": 0,
+    "days": 0,
+    "output": ".",
+    "format": "csv",
+    "seed": None,
+    "deterministic_ids": False,
+    "processes": 1,
+    "workers": 1,
+    "summary": None,
+    "columns": None,
+    "timestamp_format": None,
+    "cache": True,
+    "cache_dir": CACHE_DIR,
+    "window": None,
+}
+
+# Types of the settings that default to None, the others have the type of their default
+OPTIONAL_TYPES = {
+    "seed": int,
+    "summary": str,
+    "columns": dict,
+    "timestamp_format": str,
+    "window": str,
+}
+
+def cli(argv=None):
+    # Entry point of privseq: the run subcommand, or the interactive menu
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["run"]:
+        sys.exit(run_command(argv[1:]))
+    if argv[:1] == ["append"]:
+        sys.exit(append_command(argv[1:]))
+
+    parser = argparse.ArgumentParser(prog="privseq", description="Anonymize event logs interactively, or without prompts with 'privseq run' and 'privseq append'.")
+    parser.add_argument("--no-cache", action="store_true", help="always annotate the logs, without the cache of earlier runs")
+    main(use_cache=not parser.parse_args(argv).no_cache)
+
+def run_parser():
+    parser = argparse.ArgumentParser(prog="privseq run", description="Anonymize event logs without prompts.")
+    parser.add_argument("input", nargs="*", help="event logs, paths or glob patterns")
+    parser.add_argument("-c", "--config", help="TOML or JSON file with any of the settings below")
+    parser.add_argument("--delta", type=float)
+    parser.add_argument("--condition-number", type=float)
+    parser.add_argument("--months", type=int, help="maximum months shift")
+    parser.add_argument("--days", type=int, help="maximum days shift")
+    parser.add_argument("-o", "--output", help="output folder")
+    parser.add_argument("--format", help=f"output format, one of {', '.join(sorted(set(FORMATS.values())))}")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--deterministic-ids", action="store_true", default=None, help="derive the case ids from the seed too")
+    parser.add_argument("-p", "--processes", type=int, help="logs anonymized at the same time")
+    parser.add_argument("-w", "--workers", type=int, help="worker processes for the PK estimation of each log")
+    parser.add_argument("--summary", help="path of the run summary (<output>/run_summary.json)")
+    parser.add_argument("--timestamp-format", help="strptime format of the timestamps")
+    parser.add_argument("--no-cache", dest="cache", action="store_false", default=None, help="always annotate the logs, without the cache of earlier runs")
+    parser.add_argument("--cache-dir", help=f"folder of the annotation cache ({CACHE_DIR})")
+    parser.add_argument("--window", help="release one log per time window of this pandas period frequency (M, W, Q...), cases go to the window they start in")
+    return parser
+
+def run_command(argv):
+    parser = run_parser()
+    args = parser.parse_args(argv)
+    try:
+        config = load_config(args.config) if args.config else {}
+        flags = {key: value for key, value in vars(args).items() if key != "config" and value not in (None, [])}
+        config = run_config({**config, **flags})
+        jobs = plan_jobs(config)
+    except ValueError as e:
+        parser.error(str(e))
+
+    summary = run(jobs, config)
+    for log in summary["logs"]:
+        if log["status"] == "ok" and "windows" in log:
+            print(f"{log['input']} -> {len(log['windows'])} windows in {config['output']} ({log['seconds']['total']:.1f}s, {log['cases_removed']} cases removed)")
+        elif log["status"] == "ok":
+            print(f"{log['input']} -> {log['output']} ({log['seconds']['total']:.1f}s, {log['cases_removed']} cases removed)")
+        else:
+            print(f"{log['input']}: {log['error']}", file=sys.stderr)
+    if config["cache"]:
+        print(f"Annotation cache hits: {summary['cache']['hits']}, misses: {summary['cache']['misses']}")
+    print(f"Summary written to {summary['path']}")
+    return 0 if all(log["status"] == "ok" for log in summary["logs"]) else 1
+
+def append_command(argv):
+    # "privseq append": extend an annotated table with the events of a new log
+    parser = argparse.ArgumentParser(prog="privseq append", description="Add new events to an annotated table, refitting only the groups they change.")
+    parser.add_argument("table", help="annotated table written by an earlier annotation or append")
+    parser.add_argument("events", help="event log with the new events")
+    parser.add_argument("-o", "--output", required=True, help="path of the extended annotated table")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="worker processes for the PK estimation")
+    parser.add_argument("--timestamp-format", help="strptime format of the new timestamps")
+    parser.add_argument("--report", help="path of a JSON report of the append")
+    args = parser.parse_args(argv)
+    try:
+        df = read_table(args.table)
+        if "PK" not in df:
+            raise ValueError(f"{args.table} is not an annotated table")
+        read_options = _read_options(args.events, {"columns": None, "timestamp_format": args.timestamp_format})
+    except ValueError as e:
+        parser.error(str(e))
+
+    start = time.perf_counter()
+    df = DAFSA_append(df, args.events, read_options=read_options, workers=args.workers)
+    write_table(df, args.output)
+
+    report = {**df.attrs["append"], "seconds": round(time.perf_counter() - start, 3)}
+    print(f"{args.events}: {report['new_events']} events, {report['new_variants']} new variants, "
+          f"{report['groups_refit']} groups refitted, {report['groups_reused']} reused ({report['seconds']:.1f}s)")
+    if report["dafsa_rebuilt"]:
+        print("Some cases got events before their last one, the DAFSA was rebuilt and its states renumbered")
+    elif report["renumbered_states"] or report["removed_states"]:
+        print(f"Renumbered states: {report['renumbered_states']}, removed states: {report['removed_states']}")
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+def load_config(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".json":
+        with open(path) as f:
+            return json.load(f)
+    if ext != ".toml":
+        raise ValueError(f"Unsupported config file '{path}', expected .toml or .json")
+
+    try:
+        import tomllib
+    except ImportError:
+        try:
+            import tomli as tomllib
+        except ImportError:
+            raise ImportError("TOML configs need Python 3.11 or tomli, install it with 'pip install tomli'") from None
+    with open(path, "rb") as f:
+        return tomllib.load(f)
+
+def run_config(config):
+    # Settings with their defaults, validated as in the interactive pipeline
+    unknown = set(config) - set(RUN_DEFAULTS)
+    if unknown:
+        raise ValueError(f"Unknown settings: {', '.join(sorted(unknown))}")
+    config = {**RUN_DEFAULTS, **config}
+    if isinstance(config["input"], str):
+        config["input"] = [config["input"]]
+
+    for key, value in config.items():
+        if value is None and RUN_DEFAULTS[key] is None:
+            continue
+        expected = OPTIONAL_TYPES.get(key, type(RUN_DEFAULTS[key]))
+        if expected is float and isinstance(value, int) and not isinstance(value, bool):
+            config[key] = value = float(value)
+        if not isinstance(value, expected) or (isinstance(value, bool) and expected is not bool):
+            raise ValueError(f"Setting '{key}' must be of type {expected.__name__}, got {value!r}")
+    if not all(isinstance(path, str) for path in config["input"]):
+        raise ValueError("Setting 'input' must be a path or a list of paths")
+
+    if not (0 <= config["delta"] < 1):
+        raise ValueError("Delta value must be between 0 and 1")
+    if not (0 <= config["condition_number"] <= 1):
+        raise ValueError("Condition number must be between 0 and 1")
+    if config["months"] < 0 or config["days"] < 0:
+        raise ValueError("Months and days shift must not be negative")
+    if config["processes"] <= 0 or config["workers"] <= 0:
+        raise ValueError("Processes and workers must be positive")
+    if config["format"] not in FORMATS.values():
+        raise ValueError(f"Unknown output format '{config['format']}'")
+    if config["window"]:
+        try:
+            pd.Period("2000-01-01", freq=config["window"])
+        except ValueError:
+            raise ValueError(f"Unknown window frequency '{config['window']}'") from None
+    return config
+
+def plan_jobs(config):
+    # One job per input log, in sorted path order, which also numbers their seeds
+    paths = []
+    for pattern in config["input"]:
+        matches = sorted(glob.glob(pattern, recursive=True))
+        if not matches:
+            raise ValueError(f"No file matches '{pattern}'")
+        paths.extend(path for path in matches if path not in paths)
+    if not paths:
+        raise ValueError("No input logs given")
+
+    ext = next(ext for ext, fmt in FORMATS.items() if fmt == config["format"])
+    jobs = []
+    outputs = set()
+    for i, path in enumerate(paths):
+        log_format(path)
+        name = os.path.basename(path)
+        stem = name[:-len(_log_extension(name))]
+        output = os.path.join(config["output"], f"{stem}_anonymized{ext}")
+        if output in outputs:
+            raise ValueError(f"Two inputs would be written to {output}")
+        outputs.add(output)
+        jobs.append({"index": i, "input": path, "output": output, "stem": stem})
+    return jobs
+
+def run(jobs, config):
+    # Anonymize every job and write the run summary
+    started = datetime.now()
+    os.makedirs(config["output"], exist_ok=True)
+    start = time.perf_counter()
+
+    tasks = [(job, config) for job in jobs]
+    processes = min(config["processes"], len(jobs))
+    if config["window"]:
+        # The processes go to the windows of one log at a time
+        logs = [release_log(task) for task in tasks]
+    elif processes > 1:
+        with ProcessPoolExecutor(processes) as pool:
+            logs = list(pool.map(anonymize_log, tasks))
+    else:
+        logs = [anonymize_log(task) for task in tasks]
+
+    summary = {
+        "started": started.isoformat(timespec="seconds"),
+        "seconds": round(time.perf_counter() - start, 3),
+        "config": config,
+        "cache": {
+            "hits": sum(log.get("cache") == "hit" for log in logs),
+            "misses": sum(log.get("cache") == "miss" for log in logs),
+        },
+        "logs": logs,
+    }
+    path = config["summary"] or os.path.join(config["output"], "run_summary.json")
+    with open(path, "w") as f:
+        json.dump(summary, f, indent=2, default=str)
+    summary["path"] = path
+    return summary
+
+def anonymize_log(task):
+    # Annotation, filtering, sampling and anonymization of one log, as a summary
+    # record; errors are recorded instead of raised so the other logs still run
+    job, config = task
+    record = {"input": job["input"], "output": job["output"]}
+    seconds = {}
+    start = time.perf_counter()
+    try:
+        # Streams of the index-th log, whatever process runs it; the entropy is logged
+        # so that runs without a seed can be reproduced too
+        streams = RandomStreams(None if config["seed"] is None else [config["seed"], job["index"]])
+        record["entropy"] = streams.entropy
+
+        t = time.perf_counter()
+        df = _annotate(job, config, record)
+        seconds["annotation"] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        df_filtered = DAFSA_filtrated(df, config["delta"], config["condition_number"], workers=config["workers"])
+        seconds["filtering"] = time.perf_counter() - t
+
+        n_cases = df["CaseID"].nunique()
+        kept_cases = df_filtered["CaseID"].nunique()
+        record.update({
+            "events": len(df),
+            "cases": n_cases,
+            "events_removed": len(df) - len(df_filtered),
+            "cases_removed": n_cases - kept_cases,
+            "cases_removed_pct": round(100 * (n_cases - kept_cases) / n_cases, 4) if n_cases else 0.0,
+        })
+        del df
+
+        # Written as it is built, the sampled log is never held whole in memory
+        output_events, output_cases = write_anonymized(df_filtered, job["output"], config["months"], config["days"], streams, config["deterministic_ids"], seconds)
+        record.update({"output_events": output_events, "output_cases": output_cases})
+        record["status"] = "ok"
+    except Exception as e:
+        record.update({"status": "error", "error": f"{type(e).__name__}: {e}"})
+
+    seconds["total"] = time.perf_counter() - start
+    record["seconds"] = {stage: round(value, 3) for stage, value in seconds.items()}
+    return record
+
+def release_log(task):
+    # anonymize_log for a windowed run: one annotation, then one output per window
+    job, config = task
+    record = {"input": job["input"]}
+    seconds = {}
+    start = time.perf_counter()
+    try:
+        streams = RandomStreams(None if config["seed"] is None else [config["seed"], job["index"]])
+        record["entropy"] = streams.entropy
+
+        t = time.perf_counter()
+        df = _annotate(job, config, record, metrics=False)
+        seconds["annotation"] = time.perf_counter() - t
+
+        # Every window is written as soon as it is released
+        releases = windowed_releases(
+            df, config["window"], config["delta"], config["condition_number"], config["months"], config["days"],
+            streams, config["deterministic_ids"], config["processes"]
+        )
+        del df
+
+        ext = next(ext for ext, fmt in FORMATS.items() if fmt == config["format"])
+        seconds["windows"] = seconds["write"] = 0.0
+        record["windows"] = []
+        t = time.perf_counter()
+        for period, df_final in releases:
+            w = time.perf_counter()
+            seconds["windows"] += w - t
+            # Weekly and daily periods print as start/end
+            output = os.path.join(config["output"], f"{job['stem']}_{period.replace('/', '_')}_anonymized{ext}")
+            write_table(df_final, output)
+            record["windows"].append({"window": period, "output": output, **df_final.attrs["release"]})
+            del df_final
+            t = time.perf_counter()
+            seconds["write"] += t - w
+        seconds["windows"] += time.perf_counter() - t
+
+        windows = record["windows"]
+        record.update({
+            "events": sum(w["events"] for w in windows),
+            "cases": sum(w["cases"] for w in windows),
+            "events_removed": sum(w["events_removed"] for w in windows),
+            "cases_removed": sum(w["cases_removed"] for w in windows),
+            "status": "ok",
+        })
+    except Exception as e:
+        record.update({"status": "error", "error": f"{type(e).__name__}: {e}"})
+
+    seconds["total"] = time.perf_counter() - start
+    record["seconds"] = {stage: round(value, 3) for stage, value in seconds.items()}
+    return record
+
+def _annotate(job, config, record, metrics=True):
+    # Annotated table of a job's log, from the annotation cache when it is enabled.
+    # The cache holds whole annotations, without it metrics=False skips the PK fit.
+    read_options = _read_options(job["input"], config)
+    if not config["cache"]:
+        return DAFSA_annotated_table(job["input"], read_options=read_options, workers=config["workers"], metrics=metrics)
+
+    cache = AnnotationCache(config["cache_dir"])
+    df = cache.annotated_table(job["input"], read_options=read_options, workers=config["workers"])
+    record["cache"] = "hit" if cache.hits else "miss"
+    return df
+
+def _read_options(path, config):
+    # Standard or XES column names are recognized, anything else needs "columns"
+    if config["columns"]:
+        return ReadOptions(columns=config["columns"], timestamp_format=config["timestamp_format"])
+    columns = read_columns(path)
+    if all(col in columns for col in LOG_COLUMNS) or log_format(path) == "xes":
+        return ReadOptions(timestamp_format=config["timestamp_format"])
+    if all(src in columns for src in XES_COLUMNS):
+        return ReadOptions(columns=XES_COLUMNS, timestamp_format=config["timestamp_format"])
+    raise ValueError(f"Columns {', '.join(LOG_COLUMNS)} not found, map them with 'columns' in the config")
+
+def _log_extension(name):
+    name = name.lower()
+    return max((ext for ext in LOG_FORMATS if name.endswith(ext)), key=len)
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,208 @@
+import hashlib
+import importlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from dp_sequential_events.main.annotated import DAFSA_annotated_table
+from dp_sequential_events.main.dafsa import DAFSA
+from dp_sequential_events.main.kde import GRID_SIZE, BinnedGroups
+from dp_sequential_events.main.variants import VariantIndex
+
+# On-disk cache of annotated tables. An entry is keyed by the content hash of the input
+# log and the parameters the annotation depends on, and holds every column of the
+# table, the variant index, the DAFSA and the pk_refit KDE as .npy files. Columns are
+# copied into the frame when it is loaded, the other arrays stay memory mapped. Entries
+# are evicted least recently used first once the cache grows over its size limit.
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "privseq")
+
+CACHE_SIZE = 2 << 30
+
+# Bumped whenever the layout of an entry changes
+CACHE_VERSION = 3
+
+# Modules the annotated table is computed by. Their source is part of the key, so
+# tables annotated before a change to them are not served after it.
+ANNOTATION_MODULES = ["annotated", "dafsa", "event_log", "kde", "variants"]
+
+HASH_BLOCK = 1 << 20
+
+INDEX_ARRAYS = ["offsets", "codes", "variant", "counts", "variant_codes", "variant_offsets"]
+
+DAFSA_ARRAYS = ["indptr", "labels", "targets"]
+
+REFIT_ARRAYS = ["counts", "mean", "m2", "rows", "bins", "valid"]
+
+class AnnotationCache:
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def annotated_table(self, path, grid_size=GRID_SIZE, read_options=None, workers=1):
+        # DAFSA_annotated_table, loaded from the cache when the same log was annotated
+        # with the same parameters before
+        key = self.key(path, grid_size, read_options)
+        df = self.load(key)
+        if df is not None:
+            self.hits += 1
+            return df
+
+        self.misses += 1
+        df = DAFSA_annotated_table(path, grid_size=grid_size, read_options=read_options, workers=workers)
+        self.store(key, df)
+        return df
+
+    def key(self, path, grid_size=GRID_SIZE, read_options=None):
+        digest = hashlib.blake2b(digest_size=20)
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(HASH_BLOCK), b""):
+                digest.update(block)
+
+        # The CSV engine does not change the table, the other read options do
+        params = {"version": CACHE_VERSION, "source": _source_digest(), "grid_size": grid_size}
+        if read_options is not None:
+            params.update({
+                "columns": read_options.columns,
+                "timestamp_format": read_options.timestamp_format,
+                "epoch_unit": read_options.epoch_unit,
+                "dtype": {col: str(dtype) for col, dtype in read_options.dtype.items()},
+            })
+        digest.update(json.dumps(params, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def load(self, key):
+        # The entry can be evicted by another process while it is read, which is a miss
+        try:
+            return self._load(key)
+        except (OSError, ValueError):
+            return None
+
+    def _load(self, key):
+        entry = os.path.join(self.directory, key)
+        meta_path = os.path.join(entry, "meta.json")
+        if not os.path.isfile(meta_path):
+            return None
+        with open(meta_path) as f:
+            meta = json.load(f)
+
+        def array(name):
+            return np.load(os.path.join(entry, name + ".npy"), mmap_mode="r")
+
+        data = {}
+        for i, col in enumerate(meta["columns"]):
+            values = array(f"col_{i}")
+            categories = meta["categories"].get(col)
+            if categories is None:
+                data[col] = np.array(values)
+            else:
+                data[col] = pd.Categorical.from_codes(np.array(values), categories=pd.Index(categories))
+        df = pd.DataFrame(data)
+
+        case_col = df["CaseID"]
+        index = VariantIndex(
+            case_col.iloc[np.asarray(array("offsets")[:-1])].to_numpy(),
+            array("offsets"),
+            array("codes"),
+            np.array(meta["activities"], dtype=object),
+            array("variant"),
+            array("counts"),
+            array("variant_codes"),
+            array("variant_offsets")
+        )
+        df.attrs["variant_index"] = index
+        df.attrs["dafsa"] = DAFSA(meta["dafsa_activities"], *(array("dafsa_" + name) for name in DAFSA_ARRAYS))
+
+        refit = BinnedGroups(0, meta["refit_grid_size"])
+        for name in REFIT_ARRAYS:
+            setattr(refit, name, array("refit_" + name))
+        df.attrs["pk_refit"] = refit
+
+        # Used now, so it is the last to be evicted
+        os.utime(meta_path)
+        return df
+
+    def store(self, key, df):
+        entry = os.path.join(self.directory, key)
+        if os.path.isdir(entry):
+            return
+
+        # Written next to the entry and renamed, so a reader never sees half an entry
+        tmp = f"{entry}.tmp-{os.getpid()}"
+        os.makedirs(tmp, exist_ok=True)
+        try:
+            meta = {"columns": list(df.columns), "categories": {}}
+            for i, col in enumerate(df.columns):
+                values = df[col]
+                if isinstance(values.dtype, pd.CategoricalDtype):
+                    meta["categories"][col] = values.cat.categories.tolist()
+                    values = values.cat.codes
+                np.save(os.path.join(tmp, f"col_{i}.npy"), values.to_numpy())
+
+            index = df.attrs["variant_index"]
+            meta["activities"] = [str(act) for act in index.activities]
+            for name in INDEX_ARRAYS:
+                np.save(os.path.join(tmp, name + ".npy"), getattr(index, name))
+
+            dafsa = df.attrs["dafsa"]
+            meta["dafsa_activities"] = [str(act) for act in dafsa.activities]
+            for name in DAFSA_ARRAYS:
+                np.save(os.path.join(tmp, "dafsa_" + name + ".npy"), getattr(dafsa, name))
+
+            refit = df.attrs["pk_refit"]
+            meta["refit_grid_size"] = refit.grid_size
+            for name in REFIT_ARRAYS:
+                np.save(os.path.join(tmp, "refit_" + name + ".npy"), getattr(refit, name))
+
+            with open(os.path.join(tmp, "meta.json"), "w") as f:
+                json.dump(meta, f)
+
+            if _size(tmp) > self.max_bytes:
+                return
+            try:
+                os.rename(tmp, entry)
+            except OSError:
+                # Stored meanwhile by another process
+                return
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        # Remove the least recently used entries until the cache fits in max_bytes
+        entries = []
+        for name in os.listdir(self.directory) if os.path.isdir(self.directory) else []:
+            meta_path = os.path.join(self.directory, name, "meta.json")
+            if os.path.isfile(meta_path):
+                entries.append((os.path.getmtime(meta_path), name, _size(os.path.join(self.directory, name))))
+
+        total = sum(size for _, _, size in entries)
+        for _, name, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def report(self):
+        return f"cache hits: {self.hits}, misses: {self.misses}"
+
+def _source_digest():
+    digest = hashlib.blake2b(digest_size=20)
+    for name in ANNOTATION_MODULES:
+        with open(importlib.import_module("dp_sequential_events.main." + name).__file__, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def _size(directory):
+    return sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
@@ -1,18 +1,26 @@
 
 import numpy as np
 import pandas as pd
-import uuid
+import os
 
-def laplace_noise(scale):
-    return np.random.laplace(loc=0.0, scale=scale)
+from dp_sequential_events.main.variants import VariantIndex
+
+UUID_DIGITS = np.frombuffer(b"0123456789abcdef", dtype=np.uint8)
+
+# Columns of the hex digits in the 8-4-4-4-12 uuid layout
+UUID_POSITIONS = np.array([i for i in range(36) if i not in (8, 13, 18, 23)])
+
+def laplace_noise(scale, rng=None):
+    return np.random.default_rng(rng).laplace(loc=0.0, scale=scale)
 
 def extract_full_patterns(df):
-    patterns = (
-        df.sort_values(["CaseID", "Timestamp"])
-          .groupby("CaseID")["Activity"]
-          .apply(lambda x: "".join(x))
-          .reset_index(name="Pattern")
-    )
+    index = VariantIndex.of(df.sort_values(["CaseID", "Timestamp"], kind="stable"))
+    labels = np.array(index.labels(), dtype=object)
+
+    patterns = pd.DataFrame({
+        "CaseID": index.case_ids,
+        "Pattern": labels[index.variant]
+    })
     return patterns
 
 def count_pattern_frequencies(patterns):
@@ -23,160 +31,147 @@ def count_pattern_frequencies(patterns):
     )
     return pattern_counts
 
-def case_sampling(df, epsilon_d=1):
-    df = df.copy()
-    df["CaseID"] = df["CaseID"].astype(str)
-
-    # Group by patterns
-    patterns = extract_full_patterns(df)
-    pattern_groups = patterns.groupby("Pattern")["CaseID"].apply(list).to_dict()
-
-    # Apply Laplace noise to counts and determine how many cases to duplicate/remove
+def sorted_cases(df):
+    # (CaseID, Timestamp) sorted table the cases are drawn from, and its VariantIndex
+    df = df.sort_values(["CaseID", "Timestamp"], kind="stable").reset_index(drop=True)
+    return df, VariantIndex.of(df)
+
+def pattern_layout(index):
+    # Patterns that still have cases, the pattern of every case and the cases of every
+    # pattern, contiguous and in CaseID order. Fixed for a table, whatever is drawn.
+    return variant_layout(index.variant, index.counts)
+
+def variant_layout(variant, counts):
+    # pattern_layout of the cases of the given variants, counts being their number of
+    # cases per variant; cases of a pattern keep the order they are given in
+    present = np.flatnonzero(counts)
+    pattern_of_case = np.searchsorted(present, variant)
+    true_counts = counts[present]
+    by_pattern = np.argsort(pattern_of_case, kind="stable")
+    pattern_starts = np.concatenate([[0], np.cumsum(true_counts)[:-1]])
+    return pattern_of_case, true_counts, by_pattern, pattern_starts
+
+def draw_cases(layout, epsilon_d, rng):
+    # Cases removed (a mask) and duplicated (one entry per copy) by one draw of noisy
+    # pattern counts
+    pattern_of_case, true_counts, by_pattern, pattern_starts = layout
+
+    # Apply Laplace noise to all counts at once and determine how many cases to duplicate/remove
     scale = 1.0 / epsilon_d
-    duplication_counter = {}
-    df_final = df.copy()
-
-    for pattern, case_list in pattern_groups.items():
-        true_count = len(case_list)
-        noisy_count = int(round(true_count + laplace_noise(scale)))
-        noisy_count = max(0, noisy_count)
-        diff = noisy_count - true_count
-
-        if diff > 0:
-            # Duplicate complex cases selected randomly
-            sampled = np.random.choice(case_list, size=diff, replace=True)
-            duplicated_rows = []
-            for cid in sampled:
-                case_rows = df_final[df_final["CaseID"] == cid].copy()
-                duplication_counter[cid] = duplication_counter.get(cid, 0) + 1
-                new_id = f"{cid}_dup{duplication_counter[cid]}"
-                case_rows["CaseID"] = new_id
-                duplicated_rows.append(case_rows)
-            if duplicated_rows:
-                df_final = pd.concat([df_final] + duplicated_rows, ignore_index=True)
-
-        elif diff < 0:
-            # Delete cases randomly
-            remove_cids = np.random.choice(case_list, size=min(abs(diff), len(case_list)), replace=False)
-            df_final = df_final[~df_final["CaseID"].isin(remove_cids)].copy()
-
-    df_final = df_final.sort_values(["CaseID", "Timestamp"]).reset_index(drop=True)
-
-    return df_final, duplication_counter
-
-# Adjust noise based on duplication count
-def inject_time_noise(df, duplication_counter):
-    df = df.copy()
-
-    # Count duplications per original case
-    def adjusted_epsilon(row):
-        cid = str(row["CaseID"])
-        if "_dup" in cid:
-            original = cid.split("_dup")[0]
-        else:
-            original = cid
-        D = duplication_counter.get(original, 0) + 1
-
-        return row["ϵt"] / D if row["ϵt"] > 0 else 0.0
-
-    df["adj_ϵt"] = df.apply(adjusted_epsilon, axis=1)
-
-    noisy_rel_times = []
-
-    for idx, row in df.iterrows():
-        eps = row["adj_ϵt"]
-
-        if eps == 0:
-            noisy_rel_times.append(row["RelTime"])
-            continue
-
-        scale = 1.0 / eps
-        noise = np.random.laplace(0, scale)
-
-        noisy_rel_times.append(row["RelTime"] + noise)
-
-    df["NoisyRelTime"] = noisy_rel_times
-
-    return df
-
-# Reconstruct timestamps from noisy relative times
-def reconstruct_timestamps(df):
-    df = df.copy()
-
-    new_timestamps = []
-
-    for case_id, group in df.groupby("CaseID"):
-        group = group.sort_values("Timestamp")
-
-        t0 = group["Timestamp"].min()
-        current_time = t0
-
-        for _, row in group.iterrows():
-            rel = row["NoisyRelTime"]
-
-            if rel < 0:
-                rel = 0
-
-            current_time = current_time + pd.Timedelta(minutes=rel)
-            new_timestamps.append(current_time)
-
-    df["AnonTimestamp"] = new_timestamps
-
-    return df
-
-# Compress timestamps to original range
-def compress_timestamps(df):
-    df = df.copy()
-
-    min_original = df["Timestamp"].min()
-    max_original = df["Timestamp"].max()
-
-    min_new = df["AnonTimestamp"].min()
-    max_new = df["AnonTimestamp"].max()
-
-    original_span = (max_original - min_original).total_seconds()
-    new_span = (max_new - min_new).total_seconds()
-
-    if new_span == 0:
-        return df
-
-    factor = original_span / new_span
-
-    compressed = []
-
-    for ts in df["AnonTimestamp"]:
-        delta = (ts - min_new).total_seconds()
-        new_delta = delta * factor
-        compressed_ts = min_original + pd.Timedelta(seconds=new_delta)
-        compressed.append(compressed_ts)
-
-    df["FinalTimestamp"] = compressed
-
-    return df
-
-# Anonymize case IDs
-def anonymize_case_ids(df):
-    df = df.copy()
-
-    new_ids = {
-        cid: str(uuid.uuid4())
-        for cid in df["CaseID"].unique()
-    }
-
-    df["AnonCaseID"] = df["CaseID"].map(new_ids)
-
-    return df
-
-def clean_final_table(df):
-    df_final = df[["AnonCaseID", "Activity", "FinalTimestamp"]].copy()
-
-    df_final = df_final.rename(columns={
-        "AnonCaseID": "CaseID",
-        "Activity": "Activity",
-        "FinalTimestamp": "Timestamp"
-    })
-
-    df_final["Timestamp"] = df_final["Timestamp"].dt.floor("s")
-    df_final = df_final.sort_values(["CaseID", "Timestamp"]).reset_index(drop=True)
-
-    return df_final
\ No newline at end of file
+    noisy_counts = np.round(true_counts + rng.laplace(0.0, scale, size=len(true_counts)))
+    diff = np.maximum(0, noisy_counts).astype(np.int64) - true_counts
+
+    # Duplicate complex cases selected randomly (with replacement)
+    n_dup = np.maximum(diff, 0)
+    dup_pattern = np.repeat(np.arange(len(true_counts)), n_dup)
+    pick = (rng.random(len(dup_pattern)) * true_counts[dup_pattern]).astype(np.int64)
+    dup_cases = by_pattern[pattern_starts[dup_pattern] + pick]
+
+    # Delete cases randomly (without replacement): the first |diff| cases of each
+    # pattern after a random shuffle within the pattern
+    n_cases = len(pattern_of_case)
+    n_remove = np.minimum(np.maximum(-diff, 0), true_counts)
+    shuffled = np.lexsort((rng.random(n_cases), pattern_of_case))
+    rank = np.arange(n_cases) - pattern_starts[pattern_of_case[shuffled]]
+    removed = np.zeros(n_cases, dtype=bool)
+    removed[shuffled[rank < n_remove[pattern_of_case[shuffled]]]] = True
+
+    return removed, dup_cases
+
+class CaseSample:
+    # Sampled cases of a (CaseID, Timestamp) sorted table as multiplicities of its
+    # cases, without copying their rows. The instances are the (case, copy) pairs kept,
+    # copy 0 being the case itself and 1, 2, ... its duplicates, in case then copy
+    # order; the events of the sample are those of its instances, in that order, and
+    # rows maps them to the table.
+    def __init__(self, starts, sizes, removed, duplicates):
+        self.removed = removed
+        self.duplicates = duplicates
+
+        copies = (~removed).astype(np.int64) + duplicates
+        self.case = np.repeat(np.arange(len(sizes)), copies)
+        first = np.cumsum(copies) - copies
+        self.copy = np.arange(len(self.case)) - first[self.case] + removed[self.case]
+
+        self.sizes = sizes[self.case]
+        self.offsets = np.concatenate([[0], np.cumsum(self.sizes)]).astype(np.int64)
+        self.rows = np.repeat(starts[self.case] - self.offsets[:-1], self.sizes) + np.arange(self.n_events)
+        self.instance = np.repeat(np.arange(self.n_instances), self.sizes)
+
+    @classmethod
+    def draw(cls, index, layout, epsilon_d=1, rng=None):
+        # One draw of noisy pattern counts over the cases of index, layout being
+        # pattern_layout(index)
+        removed, dup_cases = draw_cases(layout, epsilon_d, np.random.default_rng(rng))
+        duplicates = np.bincount(dup_cases, minlength=index.n_cases)
+        return cls(index.offsets[:-1], index.sizes, removed, duplicates)
+
+    @property
+    def n_instances(self):
+        return len(self.case)
+
+    @property
+    def n_events(self):
+        return int(self.offsets[-1])
+
+def sample_time_noise(sample, eps, rng=None):
+    # Laplace noise on the relative time of every event of a sample, eps being the ϵt
+    # of the table, split between the copies of a case
+    rng = np.random.default_rng(rng)
+    eps = eps[sample.rows]
+    D = sample.duplicates[sample.case][sample.instance] + 1
+    adj = np.where(eps > 0, eps / D, 0.0)
+
+    noisy = adj != 0
+    noise = np.zeros(sample.n_events)
+    noise[noisy] = rng.laplace(0.0, 1.0 / adj[noisy])
+    return noise
+
+def sample_timestamps(sample, ns, rel, noise):
+    # Anonymized timestamps of the events of a sample, in int64 nanoseconds: every
+    # copy starts at the first timestamp of its case and adds up its noisy gaps
+    starts = sample.offsets[:-1]
+    step_ns = np.round(np.maximum(rel[sample.rows] + noise, 0) * 60e9).astype(np.int64)
+    offset_ns = np.cumsum(step_ns)
+    if sample.n_events:
+        offset_ns -= np.repeat(offset_ns[starts] - step_ns[starts], sample.sizes)
+    return np.repeat(ns[sample.rows[starts]], sample.sizes) + offset_ns
+
+def anonymized_ns(df, sample, rng=None):
+    # sample_timestamps of a sample of df with a fresh draw of sample_time_noise
+    ns = df["Timestamp"].astype("datetime64[ns]").values.view(np.int64)
+    noise = sample_time_noise(sample, df["ϵt"].values.astype(np.float64), rng)
+    return sample_timestamps(sample, ns, df["RelTime"].to_numpy(np.float64), noise)
+
+def sample_bounds(df, sample, anon_ns):
+    # (min original, max original, min anonymized, max anonymized) timestamps of the
+    # events of a sample in int64 nanoseconds, None when it has no events
+    if not sample.n_events:
+        return None
+    ns = df["Timestamp"].astype("datetime64[ns]").values.view(np.int64)[sample.rows]
+    return ns.min(), ns.max(), anon_ns.min(), anon_ns.max()
+
+def merged_bounds(a, b):
+    # sample_bounds of two samples together
+    if a is None or b is None:
+        return b if a is None else a
+    return min(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3])
+
+def compressed_ns(anon_ns, bounds):
+    # Affine map of the anonymized range onto the original one
+    min_original, max_original, min_new, max_new = bounds
+    if max_new == min_new:
+        return anon_ns
+    factor = (max_original - min_original) / (max_new - min_new)
+    return min_original + np.round((anon_ns - min_new) * factor).astype(np.int64)
+
+def new_case_ids(n, rng=None):
+    # n random version 4 uuid strings, formatted as uuid.UUID does but all at once
+    raw = np.frombuffer(os.urandom(16 * n) if rng is None else rng.bytes(16 * n), dtype=np.uint8).reshape(n, 16).copy()
+    raw[:, 6] = raw[:, 6] & 0x0F | 0x40
+    raw[:, 8] = raw[:, 8] & 0x3F | 0x80
+
+    digits = UUID_DIGITS[np.stack([raw >> 4, raw & 0x0F], axis=2).reshape(n, 32)]
+    text = np.full((n, 36), ord("-"), dtype=np.uint8)
+    text[:, UUID_POSITIONS] = digits
+    return text.view("S36").ravel().astype(str).tolist()
@@ -0,0 +1,300 @@
+import numpy as np
+import pandas as pd
+import networkx as nx
+
+# Largest states x activities table kept in dense form (4 MiB of int32), wider
+# automata fall back to CSR
+DENSE_LIMIT = 1 << 20
+
+class DAFSA:
+    # Minimal acyclic automaton over integer-coded activities. States are numbered
+    # 0..n-1 in creation order of the underlying trie and 0 is the start state.
+    def __init__(self, activities, indptr, labels, targets):
+        self.activities = np.asarray(activities, dtype=object)
+        self.codes = pd.Index(self.activities)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.labels = np.asarray(labels, dtype=np.int32)
+        self.targets = np.asarray(targets, dtype=np.int32)
+        self.start = 0
+
+        n_states, n_acts = self.n_states, len(self.activities)
+        rows = np.repeat(np.arange(n_states, dtype=np.int64), np.diff(self.indptr))
+
+        # Transitions sorted by (state, label) give a globally sorted key for lookups
+        self._keys = rows * n_acts + self.labels
+
+        if n_states * n_acts <= DENSE_LIMIT:
+            self.table = np.full((n_states, n_acts), -1, dtype=np.int32)
+            self.table[rows, self.labels] = self.targets
+        else:
+            self.table = None
+
+    # Never modified in place, so copies of a frame that carries it can share it
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    # Pickles carry the CSR arrays only, the lookup table is rebuilt on load
+    def __getstate__(self):
+        return {"activities": self.activities, "indptr": self.indptr, "labels": self.labels, "targets": self.targets}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @property
+    def n_states(self):
+        return len(self.indptr) - 1
+
+    @property
+    def n_transitions(self):
+        return len(self.targets)
+
+    @classmethod
+    def from_sequences(cls, unique_seqs):
+        unique_seqs = set(tuple(seq) for seq in unique_seqs)
+        activities = sorted({act for seq in unique_seqs for act in seq})
+        code = {act: i for i, act in enumerate(activities)}
+
+        # Codes follow the sorted activity order, so sorting coded sequences is the
+        # same as sorting the labels
+        coded = sorted(tuple(code[act] for act in seq) for seq in unique_seqs)
+
+        children = _minimize(coded)
+
+        # Renumber the surviving trie states contiguously, keeping their order
+        alive = [node for node, edges in enumerate(children) if edges is not None]
+        state_of = {node: i for i, node in enumerate(alive)}
+
+        indptr = [0]
+        labels = []
+        targets = []
+        for node in alive:
+            for act, tgt in sorted(children[node].items()):
+                labels.append(act)
+                targets.append(state_of[tgt])
+            indptr.append(len(labels))
+
+        return cls(activities, indptr, labels, targets)
+
+    @classmethod
+    def from_transitions(cls, activities, src, acts, tgt):
+        # Automaton with the given (source, activity code, target) transitions, e.g.
+        # the distinct ones of an annotated table, keeping its state numbers
+        edges = np.unique(np.stack([np.asarray(src), np.asarray(acts), np.asarray(tgt)], axis=1).astype(np.int64), axis=0)
+        n_states = int(max(edges[:, 0].max(), edges[:, 2].max())) + 1 if len(edges) else 1
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(edges[:, 0], minlength=n_states))])
+        return cls(activities, indptr, edges[:, 1], edges[:, 2])
+
+    def insert(self, sequences):
+        # Automaton that also reads the given label sequences, built by adding them one
+        # at a time with incremental minimization (Carrasco & Forcada, 2002) instead of
+        # rebuilding it from all sequences. Surviving states keep their number where
+        # possible; returns the automaton, {old: new} for the states that had to be
+        # renumbered and the old states that were merged away.
+        sequences = [tuple(seq) for seq in sequences]
+        activities = sorted(set(self.activities.tolist()).union(*sequences))
+        code = {act: i for i, act in enumerate(activities)}
+        recode = np.array([code[act] for act in self.activities], dtype=np.int64)
+
+        children = [
+            dict(zip(recode[self.labels[lo:hi]].tolist(), self.targets[lo:hi].tolist()))
+            for lo, hi in zip(self.indptr[:-1], self.indptr[1:])
+        ]
+        indeg = np.bincount(self.targets, minlength=self.n_states).tolist()
+        register = {_signature(children[s]): s for s in range(1, self.n_states)}
+
+        for seq in sequences:
+            _add_sequence(children, indeg, register, [code[act] for act in seq])
+
+        # Deleted states free their numbers for the new ones; if fewer states were
+        # created than deleted, the highest ones move down into the gaps
+        alive = [s for s, edges in enumerate(children) if edges is not None]
+        n_states = len(alive)
+        free = iter(sorted(set(range(n_states)).difference(s for s in alive if s < n_states)))
+        state_of = {s: s if s < n_states else next(free) for s in alive}
+
+        indptr = [0]
+        labels = []
+        targets = []
+        for s in sorted(alive, key=state_of.get):
+            for act, tgt in sorted(children[s].items()):
+                labels.append(act)
+                targets.append(state_of[tgt])
+            indptr.append(len(labels))
+
+        renumbered = {s: state_of[s] for s in alive if s < self.n_states and state_of[s] != s}
+        removed = [s for s in range(self.n_states) if children[s] is None]
+        return type(self)(activities, indptr, labels, targets), renumbered, removed
+
+    def encode(self, activities):
+        codes = self.codes.get_indexer(pd.Index(activities, dtype=object))
+        if (codes < 0).any():
+            missing = pd.Index(activities)[codes < 0][0]
+            raise ValueError(f"Unknown activity {missing}")
+        return codes.astype(np.int32)
+
+    def next_state(self, current, act):
+        if self.table is not None:
+            tgt = self.table[current, act]
+        else:
+            lo, hi = self.indptr[current], self.indptr[current + 1]
+            pos = lo + np.searchsorted(self.labels[lo:hi], act)
+            tgt = self.targets[pos] if pos < hi and self.labels[pos] == act else -1
+
+        if tgt < 0:
+            raise ValueError(f"No transition from {current} with {self.activities[act]}")
+        return int(tgt)
+
+    def step(self, states, acts):
+        # Vectorized next_state for aligned arrays of states and activity codes
+        states = np.asarray(states, dtype=np.int64)
+        acts = np.asarray(acts, dtype=np.int64)
+
+        if self.table is not None:
+            tgt = self.table[states, acts]
+        else:
+            query = states * len(self.activities) + acts
+            pos = np.searchsorted(self._keys, query)
+            found = pos < len(self._keys)
+            found[found] = self._keys[pos[found]] == query[found]
+            tgt = np.full(len(query), -1, dtype=np.int32)
+            tgt[found] = self.targets[pos[found]]
+
+        if (tgt < 0).any():
+            i = int(np.argmax(tgt < 0))
+            raise ValueError(f"No transition from {states[i]} with {self.activities[acts[i]]}")
+        return tgt.astype(np.int32)
+
+    def edges(self, states, acts):
+        # Index of the transition taken from every state with every activity code. A
+        # transition fixes its target, so this numbers the (source, activity, target)
+        # groups of an annotated table the same way in every chunk of it.
+        query = np.asarray(states, dtype=np.int64) * len(self.activities) + np.asarray(acts, dtype=np.int64)
+        pos = np.searchsorted(self._keys, query)
+        found = pos < len(self._keys)
+        found[found] = self._keys[pos[found]] == query[found]
+        if not found.all():
+            i = int(np.argmin(found))
+            raise ValueError(f"No transition from {query[i] // len(self.activities)} with {self.activities[query[i] % len(self.activities)]}")
+        return pos
+
+    def table_edges(self, df):
+        # edges of every event of an annotated table
+        activity = df["Activity"].astype("category")
+        return self.edges(df["SrcState"].to_numpy(), self.encode(activity.cat.categories)[activity.cat.codes.to_numpy()])
+
+    def walk(self, acts, start=None):
+        # States visited while reading acts, including the one we start from
+        path = np.empty(len(acts) + 1, dtype=np.int32)
+        path[0] = self.start if start is None else start
+        for i, act in enumerate(acts):
+            path[i + 1] = self.next_state(path[i], act)
+        return path
+
+    def to_networkx(self):
+        G = nx.MultiDiGraph()
+        G.add_nodes_from(range(self.n_states))
+        rows = np.repeat(np.arange(self.n_states), np.diff(self.indptr))
+        for src, act, tgt in zip(rows, self.labels, self.targets):
+            G.add_edge(int(src), int(tgt), label=self.activities[act])
+        return G
+
+def _signature(edges):
+    return tuple(sorted(edges.items()))
+
+def _add_sequence(children, indeg, register, seq):
+    # Add one coded sequence to the minimal automaton in children, updating in-degrees
+    # and the register of (outgoing transitions) -> state in place
+    path = [0]
+    for act in seq:
+        tgt = children[path[-1]].get(act)
+        if tgt is None:
+            break
+        path.append(tgt)
+    prefix = len(path) - 1
+    if prefix == len(seq):
+        return
+
+    # States from the first confluence state on are shared with other prefixes, the
+    # path gets its own clones of them before they are modified. The states before it
+    # are modified in place, so they leave the register until they are minimized.
+    confluence = next((i for i in range(1, len(path)) if indeg[path[i]] > 1), len(path))
+    for state in path[1:confluence]:
+        del register[_signature(children[state])]
+
+    if confluence < len(path):
+        for i in range(confluence, len(path)):
+            clone = len(children)
+            children.append(dict(children[path[i]]))
+            indeg.append(1)
+            for tgt in children[clone].values():
+                indeg[tgt] += 1
+            children[path[i - 1]][seq[i - 1]] = clone
+            indeg[path[i]] -= 1
+            path[i] = clone
+
+    for act in seq[prefix:]:
+        children.append({})
+        indeg.append(1)
+        children[path[-1]][act] = len(children) - 1
+        path.append(len(children) - 1)
+
+    # Merge the path into equivalent registered states, deepest first
+    for i in range(len(path) - 1, 0, -1):
+        state = path[i]
+        signature = _signature(children[state])
+        equivalent = register.get(signature)
+        if equivalent is None or equivalent == state:
+            register[signature] = state
+            continue
+
+        children[path[i - 1]][seq[i - 1]] = equivalent
+        indeg[equivalent] += 1
+        for tgt in children[state].values():
+            indeg[tgt] -= 1
+        children[state] = None
+
+def _minimize(sorted_seqs):
+    # Incremental minimization for sorted input: only the states on the path of the
+    # previous sequence stay unminimized, every other state lives in a register keyed
+    # by the signature of its outgoing (label, target) transitions.
+    children = [{}]
+    register = {}
+    path = [0]
+    prev = ()
+
+    def minimize(path, depth):
+        # Fold the states deeper than depth into the register, leaves first
+        for i in range(len(path) - 1, depth, -1):
+            parent, child = path[i - 1], path[i]
+            signature = tuple(sorted(children[child].items()))
+            equivalent = register.get(signature)
+            if equivalent is None:
+                register[signature] = child
+            else:
+                for act, tgt in children[parent].items():
+                    if tgt == child:
+                        children[parent][act] = equivalent
+                children[child] = None
+
+    for seq in sorted_seqs:
+        prefix = 0
+        while prefix < min(len(seq), len(prev)) and seq[prefix] == prev[prefix]:
+            prefix += 1
+
+        minimize(path, prefix)
+        del path[prefix + 1:]
+
+        for act in seq[prefix:]:
+            children.append({})
+            children[path[-1]][act] = len(children) - 1
+            path.append(len(children) - 1)
+        prev = seq
+
+    minimize(path, 0)
+
+    # States keep their trie creation number, so each merged class is represented by
+    # its oldest state, exactly as a pairwise merge loop would leave it
+    return children
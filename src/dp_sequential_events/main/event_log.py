@@ -0,0 +1,397 @@
+import gzip
+import os
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pandas as pd
+
+# Reading and writing event logs and pipeline tables as CSV, Parquet or Feather (Arrow
+# IPC). Parquet and Feather need pyarrow. They keep the column types, so activities are
+# stored dictionary encoded and timestamps as typed columns that are read back without
+# parsing, and only the columns of the event log are read from them. Event logs can
+# also be read from XES, plain or gzip compressed, with an incremental parser.
+
+LOG_COLUMNS = ["CaseID", "Activity", "Timestamp"]
+
+FORMATS = {
+    ".csv": "csv",
+    ".parquet": "parquet",
+    ".pq": "parquet",
+    ".feather": "feather",
+    ".arrow": "feather",
+}
+
+# Event logs are read from any table format and from XES, which is never written
+LOG_FORMATS = {
+    **FORMATS,
+    ".xes": "xes",
+    ".xes.gz": "xes",
+}
+
+# Column types of the annotated and filtered tables, restored when they are read back
+TABLE_DTYPES = {
+    "SrcState": np.int32,
+    "TgtState": np.int32,
+    "NrmRelTime": np.float32,
+    "Prec": np.float32,
+    "PK": np.float32,
+    "New PK": np.float32,
+    "ϵt": np.float32,
+}
+
+# Column names of event logs exported from XES (pm4py and most process mining tools)
+XES_COLUMNS = {
+    "case:concept:name": "CaseID",
+    "concept:name": "Activity",
+    "time:timestamp": "Timestamp",
+}
+
+class ReadOptions:
+    # How the columns of a source log map onto CaseID, Activity and Timestamp and how
+    # they are parsed. columns maps source names to those three (unmapped ones keep
+    # their name), timestamp_format is a strptime format ("ISO8601" and None, which
+    # infers it, are accepted too), epoch_unit reads numeric timestamps ("s", "ms",
+    # "us" or "ns"), dtype gives dtypes of source columns and engine is the CSV parser,
+    # "c" or "pyarrow". Only the three mapped columns are read.
+    def __init__(self, columns=None, timestamp_format=None, epoch_unit=None, dtype=None, engine="c"):
+        self.columns = dict(columns or {})
+        self.timestamp_format = timestamp_format
+        self.epoch_unit = epoch_unit
+        self.dtype = dict(dtype or {})
+        self.engine = engine
+
+        if engine not in ("c", "pyarrow"):
+            raise ValueError(f"Unknown CSV engine '{engine}', expected 'c' or 'pyarrow'")
+        if timestamp_format is not None and epoch_unit is not None:
+            raise ValueError("Give either a timestamp format or an epoch unit, not both")
+
+    def source(self, column):
+        # Source name of one of LOG_COLUMNS
+        for src, name in self.columns.items():
+            if name == column:
+                return src
+        return column
+
+    @property
+    def usecols(self):
+        return [self.source(col) for col in LOG_COLUMNS]
+
+    def csv_kwargs(self):
+        # pd.read_csv arguments of the c engine: activities are parsed straight into a
+        # categorical and timestamps while reading, without a column of strings
+        kwargs = {"usecols": self.usecols, "dtype": {self.source("Activity"): "category", **self.dtype}}
+        if self.epoch_unit is None:
+            kwargs["parse_dates"] = [self.source("Timestamp")]
+            kwargs["date_format"] = self.timestamp_format
+        return kwargs
+
+    def arrow_convert_options(self):
+        # pyarrow.csv options of the pyarrow engine, which parses timestamps natively
+        pa = _pyarrow()
+        column_types = {self.source("Activity"): pa.dictionary(pa.int32(), pa.string())}
+        timestamp_parsers = None
+        if self.epoch_unit is None and self.timestamp_format is not None:
+            column_types[self.source("Timestamp")] = pa.timestamp("ns")
+            timestamp_parsers = [pa.csv.ISO8601 if self.timestamp_format == "ISO8601" else self.timestamp_format]
+
+        return pa.csv.ConvertOptions(
+            include_columns=self.usecols,
+            column_types=column_types,
+            timestamp_parsers=timestamp_parsers
+        )
+
+def table_format(path):
+    return _format(path, FORMATS)
+
+def log_format(path):
+    return _format(path, LOG_FORMATS)
+
+def _format(path, formats):
+    root, ext = os.path.splitext(str(path).lower())
+    if ext == ".gz":
+        ext = os.path.splitext(root)[1] + ext
+    if ext not in formats:
+        raise ValueError(f"Unsupported file type '{ext}', expected one of {', '.join(formats)}")
+    return formats[ext]
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.csv
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Parquet and Feather files need pyarrow, install it with 'pip install pyarrow'") from None
+    return pyarrow
+
+def read_columns(path):
+    fmt = log_format(path)
+    if fmt == "csv":
+        return list(pd.read_csv(path, nrows=0).columns)
+    if fmt == "xes":
+        return _xes_columns(path)
+
+    pa = _pyarrow()
+    if fmt == "parquet":
+        return list(pa.parquet.read_schema(path).names)
+    with pa.memory_map(str(path)) as source:
+        return list(pa.ipc.open_file(source).schema.names)
+
+def read_log(path, options=None):
+    # Event log with only CaseID, Activity and Timestamp, activities as a categorical
+    options = ReadOptions() if options is None else options
+    fmt = log_format(path)
+    if fmt == "xes":
+        options = _xes_options(options)
+        return _typed_log(next(_iter_xes(path, None, options)), options)
+    if fmt == "csv" and options.engine == "c":
+        log = pd.read_csv(path, **options.csv_kwargs())
+    elif fmt == "csv":
+        pa = _pyarrow()
+        log = pa.csv.read_csv(path, convert_options=options.arrow_convert_options()).to_pandas()
+    elif fmt == "parquet":
+        _pyarrow()
+        log = pd.read_parquet(path, columns=options.usecols)
+    else:
+        _pyarrow()
+        log = pd.read_feather(path, columns=options.usecols)
+    return _typed_log(log, options)
+
+def iter_log(path, chunk_rows, options=None):
+    # read_log in chunks of at most chunk_rows events, in file order
+    options = ReadOptions() if options is None else options
+    fmt = log_format(path)
+    if fmt == "xes":
+        options = _xes_options(options)
+        for chunk in _iter_xes(path, chunk_rows, options):
+            yield _typed_log(chunk, options)
+        return
+
+    if fmt == "csv" and options.engine == "c":
+        reader = pd.read_csv(path, chunksize=chunk_rows, **options.csv_kwargs())
+        for chunk in reader:
+            yield _typed_log(chunk, options)
+        return
+
+    pa = _pyarrow()
+    if fmt == "parquet":
+        for batch in pa.parquet.ParquetFile(path).iter_batches(batch_size=chunk_rows, columns=options.usecols):
+            yield _typed_log(batch.to_pandas(), options)
+        return
+
+    if fmt == "csv":
+        batches = pa.csv.open_csv(path, convert_options=options.arrow_convert_options())
+        for batch in batches:
+            for start in range(0, batch.num_rows, chunk_rows):
+                yield _typed_log(batch.slice(start, chunk_rows).to_pandas(), options)
+        return
+
+    with pa.memory_map(str(path)) as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i).select(options.usecols)
+            for start in range(0, batch.num_rows, chunk_rows):
+                yield _typed_log(batch.slice(start, chunk_rows).to_pandas(), options)
+
+def count_rows(path):
+    # Exact for Parquet and Feather, from the metadata; extrapolated from the lines or
+    # events in the first MiB for CSV and XES (of the decompressed stream for .xes.gz,
+    # scaled by the compressed bytes it came from)
+    fmt = log_format(path)
+    if fmt in ("csv", "xes"):
+        size = os.path.getsize(path)
+        with open(path, "rb") as raw:
+            if str(path).lower().endswith(".gz"):
+                head = gzip.GzipFile(fileobj=raw).read(1 << 20)
+            else:
+                head = raw.read(1 << 20)
+            consumed = raw.tell()
+        count = head.count(b"\n") if fmt == "csv" else head.count(b"<event")
+        return max(1, round(size * count / max(consumed, 1)))
+
+    pa = _pyarrow()
+    if fmt == "parquet":
+        return pa.parquet.ParquetFile(path).metadata.num_rows
+    with pa.memory_map(str(path)) as source:
+        reader = pa.ipc.open_file(source)
+        return sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+
+def read_table(path):
+    # Annotated, filtered or anonymized table written by write_table
+    fmt = table_format(path)
+    if fmt == "csv":
+        df = pd.read_csv(path, parse_dates=["Timestamp"])
+    elif fmt == "parquet":
+        _pyarrow()
+        df = pd.read_parquet(path)
+    else:
+        _pyarrow()
+        df = pd.read_feather(path)
+
+    # Parquet keeps the dictionary of string columns only, CSV none of the types
+    df = _typed_log(df, ReadOptions())
+    df["CaseID"] = df["CaseID"].astype("category")
+    return df.astype({col: dtype for col, dtype in TABLE_DTYPES.items() if col in df})
+
+def write_table(df, path):
+    fmt = table_format(path)
+    df = _plain(df)
+    if fmt == "csv":
+        df.to_csv(path, index=False)
+    elif fmt == "parquet":
+        _pyarrow()
+        df.to_parquet(path, index=False)
+    else:
+        _pyarrow()
+        df.reset_index(drop=True).to_feather(path)
+
+class TableWriter:
+    # write_table for a table that comes in pieces with the same columns, appended in order
+    def __init__(self, path):
+        self.path = path
+        self.format = table_format(path)
+        self._writer = None
+        self._schema = None
+        self._rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, df):
+        df = _plain(df)
+        if self.format == "csv":
+            df.to_csv(self.path, index=False, mode="a" if self._rows else "w", header=not self._rows)
+        else:
+            pa = _pyarrow()
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self._writer is None:
+                self._schema = table.schema
+                if self.format == "parquet":
+                    self._writer = pa.parquet.ParquetWriter(self.path, self._schema)
+                else:
+                    self._writer = pa.ipc.new_file(self.path, self._schema)
+            self._writer.write_table(table.cast(self._schema))
+        self._rows += len(df)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+def _plain(df):
+    # Shallow copy without the in-memory metadata of the pipeline (variant index...)
+    df = df.copy(deep=False)
+    df.attrs = {}
+    return df
+
+def _typed_log(log, options):
+    # Standard column names, string categories for the activities and naive
+    # nanosecond timestamps (UTC for timezone-aware sources), whatever the source
+    log = log.rename(columns=options.columns)
+    if options.dtype:
+        log = log.astype({options.columns.get(col, col): dtype for col, dtype in options.dtype.items() if options.columns.get(col, col) in log})
+
+    activity = log["Activity"]
+    if isinstance(activity.dtype, pd.CategoricalDtype):
+        activity = activity.cat.rename_categories(activity.cat.categories.astype(str))
+        log["Activity"] = activity.cat.reorder_categories(activity.cat.categories.sort_values())
+    else:
+        log["Activity"] = activity.astype(str).astype("category")
+
+    log["Timestamp"] = _parse_timestamps(log["Timestamp"], options)
+    return log
+
+def _parse_timestamps(col, options):
+    if options.epoch_unit is not None:
+        ts = pd.to_datetime(col, unit=options.epoch_unit)
+    elif col.dtype.kind == "M" or isinstance(col.dtype, pd.DatetimeTZDtype):
+        ts = col
+    else:
+        # utc=True accepts mixed offsets and leaves naive timestamps as they are
+        ts = pd.to_datetime(col, format=options.timestamp_format, utc=True)
+
+    if isinstance(ts.dtype, pd.DatetimeTZDtype):
+        ts = ts.dt.tz_convert(None)
+    return ts.astype("datetime64[ns]")
+
+def _xes_options(options):
+    # XES attributes keep their pm4py names unless mapped otherwise, and XES dates are
+    # xs:dateTime
+    return ReadOptions(
+        columns=options.columns or XES_COLUMNS,
+        timestamp_format=options.timestamp_format or (None if options.epoch_unit else "ISO8601"),
+        epoch_unit=options.epoch_unit,
+        dtype=options.dtype,
+        engine=options.engine
+    )
+
+def _open_xes(path):
+    return gzip.open(path, "rb") if str(path).lower().endswith(".gz") else open(path, "rb")
+
+def _local(tag):
+    return tag.rpartition("}")[2]
+
+def _xes_columns(path):
+    # Attribute keys of the first trace (with the case: prefix pm4py gives them) and of
+    # its first event
+    columns = []
+    with _open_xes(path) as f:
+        for event, elem in ET.iterparse(f, events=("end",)):
+            tag = _local(elem.tag)
+            if tag == "event" and not columns:
+                columns = [child.get("key") for child in elem]
+            elif tag == "trace":
+                return ["case:" + child.get("key") for child in elem if _local(child.tag) != "event"] + columns
+    return columns
+
+def _iter_xes(path, chunk_rows, options):
+    # Frames of at most chunk_rows events (all of them for None) with the source column
+    # names of options. Events are buffered per trace, since the trace attributes may
+    # follow them, and every finished trace is dropped from the tree, so memory depends
+    # on the chunk size and the longest trace only.
+    sources = options.usecols
+    event_keys = [src for src in sources if not src.startswith("case:")]
+
+    chunk = [[] for _ in sources]
+    events = []
+    with _open_xes(path) as f:
+        parser = ET.iterparse(f, events=("start", "end"))
+        _, root = next(parser)
+        for event, elem in parser:
+            if event == "start":
+                continue
+
+            tag = _local(elem.tag)
+            if tag == "event":
+                values = dict.fromkeys(event_keys)
+                for child in elem:
+                    key = child.get("key")
+                    if key in values:
+                        values[key] = child.get("value")
+                events.append(values)
+                elem.clear()
+
+            elif tag == "trace":
+                trace = {child.get("key"): child.get("value") for child in elem if _local(child.tag) != "event"}
+                for src, col in zip(sources, chunk):
+                    if src.startswith("case:"):
+                        values = [trace.get(src[len("case:"):])] * len(events)
+                    else:
+                        values = [e[src] for e in events]
+                    if None in values:
+                        raise ValueError(f"Event without '{src}' in trace {trace.get('concept:name')}")
+                    col.extend(values)
+                events = []
+                root.clear()
+
+                while chunk_rows is not None and len(chunk[0]) >= chunk_rows:
+                    yield _xes_frame(chunk, sources, chunk_rows)
+                    chunk = [col[chunk_rows:] for col in chunk]
+
+    if chunk[0] or chunk_rows is None:
+        yield _xes_frame(chunk, sources, None)
+
+def _xes_frame(chunk, sources, rows):
+    return pd.DataFrame({src: col[:rows] for src, col in zip(sources, chunk)})
@@ -1,51 +1,81 @@
 
-from dp_sequential_events.main.annotated import estimate_pk
+from dp_sequential_events.main.kde import GRID_SIZE, batched_pk, group_ids, metric_values
+from dp_sequential_events.main.variants import VariantIndex
 import numpy as np
-import pandas as pd
 import warnings
 warnings.simplefilter("ignore", FutureWarning)
 
-def epsilon_t(group, delta):
-    r = group["RelTime"].max() - group["RelTime"].min()
-    if r == 0:
-        r = 1.0
+def epsilon_t(new_pk, delta):
+    # Element-wise over the New PK column
+    pk = np.clip(np.asarray(new_pk, dtype=np.float64), 1e-6, 1 - 1e-6)
+    epsilon_k = np.log((1 - pk + 1e-6) / (pk + 1e-6)) + np.log(1 / delta)
 
-    epsilons = []
+    return np.maximum(epsilon_k, 0.0)
 
-    for pk in group["New PK"]:
-        pk = np.clip(pk, 1e-6, 1 - 1e-6)
-        epsilon_k = np.log((1 - pk + 1e-6) / (pk + 1e-6)) + np.log(1 / delta)
+def kept_events(df_annotated, delta, condition_number):
+    # Events of the cases with no event satisfying PK + delta >= condition_number
+    pk = metric_values(df_annotated, "PK")
+    risky_cases = df_annotated["CaseID"][pk + delta >= condition_number].unique()
+    return ~df_annotated["CaseID"].isin(risky_cases).values
 
-        epsilon_k = max(epsilon_k, 0.0)
-    
-        epsilons.append(epsilon_k)
-    return pd.Series(epsilons, index=group.index)
-
-def DAFSA_filtrated(df_annotated, delta=0.3, condition_number=1):
+def DAFSA_filtrated(df_annotated, delta=0.3, condition_number=1, grid_size=GRID_SIZE, workers=1):
     # 1. Identify cases with condición: PK + delta >= 1
-    risky_cases = df_annotated[df_annotated["PK"] + delta >= condition_number]["CaseID"].unique()
+    keep = kept_events(df_annotated, delta, condition_number)
 
     # 2. Filter the dataframe cases
-    df = df_annotated[~df_annotated["CaseID"].isin(risky_cases)].copy()
-
-    # 3. Recalculate PK for the filtered dataframe
-    group_cols = ["SrcState", "Activity", "TgtState"]
-    df["New PK"] = (
-        df.groupby(group_cols)
-        .apply(lambda g: estimate_pk(g, delta=delta, name="New PK")["New PK"])
-        .values
-    )
+    df = df_annotated[keep].copy()
+
+    # The variant index follows the surviving cases
+    index = VariantIndex.of(df_annotated)
+    df.attrs["variant_index"] = index.subset(keep[index.offsets[:-1]])
+
+    # 3. New PK is fitted on the rounded NrmRelTime and Prec of the surviving events.
+    # The groups that lost no events take it from the KDE the annotation kept of them
+    # (pk_refit), which gives the same values; without one, every group is fitted.
+    dafsa = df_annotated.attrs.get("dafsa")
+    refit_state = df_annotated.attrs.get("pk_refit")
+    if dafsa is not None and refit_state is not None:
+        groups = dafsa.table_edges(df_annotated)
+        if refit_state.grid_size != grid_size or not refit_state.matches(groups):
+            refit_state = None
+    else:
+        groups = group_ids(df_annotated, ["SrcState", "Activity", "TgtState"])
+        refit_state = None
+
+    dirty = np.zeros(groups.max() + 1 if len(groups) else 0, dtype=bool)
+    dirty[groups[~keep]] = True
+    if refit_state is None:
+        dirty[:] = True
+
+    groups = groups[keep]
+    t = metric_values(df, "NrmRelTime")
+    prec = metric_values(df, "Prec")
+    new_pk = np.empty(len(df))
+
+    clean = np.flatnonzero(~dirty[groups])
+    if len(clean):
+        new_pk[clean] = refit_state.pk(t[clean], prec[clean], groups[clean])
+        new_pk[clean[np.isnan(new_pk[clean])]] = (1 - delta) / 2
+
+    refit = np.flatnonzero(dirty[groups])
+    new_pk[refit] = batched_pk(t[refit], prec[refit], groups[refit], delta=delta, grid_size=grid_size, workers=workers)
+
+    df["New PK"] = new_pk
     df = df.reset_index(drop=True)
     df = df.drop(columns=["PK"])
+    df.attrs.pop("pk_refit", None)
+    df.attrs["pk_groups"] = {
+        "reused": len(np.unique(groups[clean])),
+        "refit": len(np.unique(groups[refit])),
+    }
 
     # 4. Calculate ϵt for the filtered dataframe
-    df["ϵt"] = df.groupby(group_cols, group_keys=False).apply(lambda g: epsilon_t(g, delta))
-    df = df.reset_index(drop=True)
+    df["ϵt"] = epsilon_t(df["New PK"].values, delta)
     df = df.drop(columns=["Prec"])
     df = df.drop(columns=["NrmRelTime"])
 
-    # 5. Round numeric columns 
-    numeric_cols = df.select_dtypes(include=[np.number]).columns
-    df[numeric_cols] = df[numeric_cols].round(2)
+    # 5. Round the metrics, kept as float32 like in the annotated table
+    metric_cols = ["New PK", "ϵt"]
+    df[metric_cols] = df[metric_cols].round(2).astype(np.float32)
 
     return df
\ No newline at end of file
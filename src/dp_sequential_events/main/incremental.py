@@ -0,0 +1,191 @@
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from dp_sequential_events.main.annotated import precision
+from dp_sequential_events.main.dafsa import DAFSA
+from dp_sequential_events.main.event_log import LOG_COLUMNS, read_log
+from dp_sequential_events.main.kde import GRID_SIZE, batched_pk, metric_values, refit_state
+from dp_sequential_events.main.variants import VariantIndex
+
+# Appending events to an annotated table. The result is the table DAFSA_annotated_table
+# would build for the whole log (up to the numbering of the DAFSA states), but only the
+# new variants are inserted into the DAFSA, and relative times, precisions and PK are
+# only recomputed for the transition groups whose events changed. Every other group
+# keeps the values of the table it is appended to.
+
+def DAFSA_append(df_annotated, new_events, grid_size=GRID_SIZE, read_options=None, workers=1):
+    # new_events is a log file or a frame with the LOG_COLUMNS. The report of the
+    # append (what was recomputed and which states were renumbered) is kept in
+    # df.attrs["append"].
+    if isinstance(new_events, pd.DataFrame):
+        new_log = new_events[LOG_COLUMNS]
+    else:
+        new_log = read_log(new_events, read_options)
+    old = df_annotated
+    n_old = len(old)
+
+    # 1. Old and new events together, sorted as DAFSA_annotated_table sorts the log.
+    # The old table is already sorted, so ties keep their order.
+    case_ids = pd.Series(np.concatenate([old["CaseID"].to_numpy(), new_log["CaseID"].to_numpy()])).astype("category")
+    activities = union_categoricals([old["Activity"].astype("category"), new_log["Activity"].astype("category")], sort_categories=True)
+    timestamps = np.concatenate([old["Timestamp"].to_numpy("datetime64[ns]"), new_log["Timestamp"].to_numpy("datetime64[ns]")])
+
+    order = np.lexsort((timestamps.view(np.int64), case_ids.cat.codes.to_numpy()))
+    log = pd.DataFrame({
+        "CaseID": case_ids.take(order).reset_index(drop=True),
+        "Activity": pd.Categorical(activities).take(order),
+        "Timestamp": timestamps[order],
+    })
+    origin = order
+
+    # Cases with new events are annotated again. A new earliest event moves the start
+    # every first event is measured from, so then all of them are.
+    ns = log["Timestamp"].values.view(np.int64)
+    case_codes = log["CaseID"].cat.codes.to_numpy()
+    touched = np.zeros(len(log["CaseID"].cat.categories), dtype=bool)
+    touched[case_codes[origin >= n_old]] = True
+    old_start = old["Timestamp"].min() if n_old else None
+    if n_old and len(ns) and ns.min() < pd.Timestamp(old_start).value:
+        touched[:] = True
+    changed_rows = touched[case_codes]
+
+    # 2. Variants of the whole log, and the DAFSA extended with the new ones
+    index = VariantIndex.from_log(log)
+    old_index = VariantIndex.of(old)
+    old_dafsa = old.attrs.get("dafsa")
+    if old_dafsa is None:
+        old_dafsa = dafsa_of_table(old)
+    dafsa, renumbered, removed, rebuilt = _extend_dafsa(old_dafsa, old_index, index)
+
+    # 3. States of every event, from one walk per variant as in DAFSA_annotated_table
+    after_start = dafsa.next_state(dafsa.start, dafsa.encode(["START"])[0])
+    to_dafsa = dafsa.encode(index.activities)
+    paths = [dafsa.walk(to_dafsa[index.sequence_codes(v)], start=after_start) for v in range(index.n_variants)]
+    path_offsets = np.concatenate([[0], np.cumsum([len(p) for p in paths])[:-1]])
+    paths = np.concatenate(paths)
+    pos = path_offsets[index.event_variant()] + index.event_step()
+    src, tgt = paths[pos], paths[pos + 1]
+
+    first = index.offsets[:-1]
+    rel = np.empty(len(ns))
+    rel[1:] = np.diff(ns) / 60e9
+    rel[first] = (ns[first] - ns.min()) / 86400e9
+
+    # 4. Groups whose events are exactly those of one old group, none of them changed,
+    # keep their metrics; the others are normalized and fitted again
+    groups = dafsa.edges(src, to_dafsa[index.codes])
+    n_groups = dafsa.n_transitions
+    old_groups_of_rows = np.full(len(log), -1, dtype=np.int64)
+    kept_rows = np.flatnonzero(~changed_rows)
+    if n_old:
+        old_groups = old_dafsa.edges(old["SrcState"].to_numpy(), _activity_codes(old_dafsa, old["Activity"]))
+        old_groups_of_rows[kept_rows] = old_groups[origin[kept_rows]]
+        old_sizes = np.bincount(old_groups, minlength=old_dafsa.n_transitions)
+
+    sizes = np.bincount(groups, minlength=n_groups)
+    stable = np.bincount(groups[kept_rows], minlength=n_groups)
+    lo = np.full(n_groups, np.iinfo(np.int64).max)
+    hi = np.full(n_groups, -1)
+    np.minimum.at(lo, groups[kept_rows], old_groups_of_rows[kept_rows])
+    np.maximum.at(hi, groups[kept_rows], old_groups_of_rows[kept_rows])
+    reused = (sizes > 0) & (stable == sizes) & (lo == hi)
+    if n_old:
+        reused[reused] &= old_sizes[lo[reused]] == sizes[reused]
+
+    nrm = np.empty(len(log))
+    prec = np.empty(len(log))
+    pk = np.empty(len(log))
+    reuse_rows = np.flatnonzero(reused[groups])
+    for col, out in [("NrmRelTime", nrm), ("Prec", prec), ("PK", pk)]:
+        out[reuse_rows] = old[col].to_numpy()[origin[reuse_rows]]
+
+    refit_rows = np.flatnonzero(~reused[groups])
+    if len(refit_rows):
+        refit_groups = groups[refit_rows]
+        min_rt = np.full(n_groups, np.inf)
+        max_rt = np.full(n_groups, -np.inf)
+        np.minimum.at(min_rt, refit_groups, rel[refit_rows])
+        np.maximum.at(max_rt, refit_groups, rel[refit_rows])
+        min_rt, max_rt = min_rt[refit_groups], max_rt[refit_groups]
+        range_rt = max_rt - min_rt
+
+        nrm[refit_rows] = np.where(range_rt == 0, 0.0, (rel[refit_rows] - min_rt) / np.where(range_rt == 0, 1, range_rt))
+        prec[refit_rows] = precision(rel[refit_rows], min_rt, max_rt)
+        pk[refit_rows] = batched_pk(nrm[refit_rows], prec[refit_rows], refit_groups, grid_size=grid_size, workers=workers)
+
+    # 5. Same layout and rounding as DAFSA_annotated_table
+    df = log
+    df["SrcState"] = src
+    df["TgtState"] = tgt
+    df["RelTime"] = rel.round(2)
+    df["NrmRelTime"] = nrm
+    df["Prec"] = prec
+    df["PK"] = pk
+    metric_cols = ["NrmRelTime", "Prec", "PK"]
+    df[metric_cols] = df[metric_cols].round(2).astype(np.float32)
+
+    df.attrs["variant_index"] = index
+    df.attrs["dafsa"] = dafsa
+
+    # The pk_refit KDE of the reused groups is the old one, if the old table has it
+    nrm = metric_values(df, "NrmRelTime")
+    old_state = old.attrs.get("pk_refit")
+    if n_old and old_state is not None and old_state.grid_size == grid_size and old_state.matches(old_groups):
+        state = refit_state(nrm[refit_rows], groups[refit_rows], n_groups, grid_size)
+        reused_ids = np.flatnonzero(reused)
+        state.take(old_state, reused_ids, lo[reused_ids])
+    else:
+        state = refit_state(nrm, groups, n_groups, grid_size)
+    df.attrs["pk_refit"] = state
+
+    df.attrs["append"] = {
+        "new_events": len(new_log),
+        "cases_annotated": int(touched.sum()),
+        "new_variants": index.n_variants - len(set(index.sequences()) & set(old_index.sequences())),
+        "groups_reused": int(reused.sum()),
+        "groups_refit": int(((sizes > 0) & ~reused).sum()),
+        "dafsa_rebuilt": rebuilt,
+        "renumbered_states": renumbered,
+        "removed_states": removed,
+    }
+    return df
+
+def dafsa_of_table(df):
+    # DAFSA of an annotated table that lost its attrs (e.g. read back from a file),
+    # from its distinct transitions plus the START one, keeping its state numbers
+    activity = df["Activity"].astype("category").cat.remove_unused_categories()
+    dafsa = DAFSA(sorted(set(activity.cat.categories) | {"START"}), [0], [], [])
+    after_start = int(df["SrcState"].iloc[0]) if len(df) else 1
+    return DAFSA.from_transitions(
+        dafsa.activities,
+        np.append(df["SrcState"].to_numpy(), 0),
+        np.append(_activity_codes(dafsa, activity), dafsa.encode(["START"])[0]),
+        np.append(df["TgtState"].to_numpy(), after_start)
+    )
+
+def _activity_codes(dafsa, activity):
+    # DAFSA codes of an activity column, translated through its categories
+    activity = activity.astype("category").cat.remove_unused_categories()
+    return dafsa.encode(activity.cat.categories)[activity.cat.codes.to_numpy()]
+
+def _extend_dafsa(dafsa, old_index, index):
+    # The DAFSA reads every prefix of the old variants. Appended events only extend
+    # cases, so the new variants are inserted into it; if an old variant is neither
+    # left nor a prefix of a new one (events inserted before others of their case), it
+    # has to go, which insertion cannot do, and the DAFSA is built again.
+    sequences = index.sequences()
+    old_sequences = set(old_index.sequences())
+    new_sequences = [("START",) + seq for seq in sequences if seq not in old_sequences]
+
+    present = set(sequences)
+    gone = [seq for seq in old_sequences if seq not in present]
+    if gone:
+        prefixes = {seq[:n] for seq in sequences for n in range(1, len(seq) + 1)}
+        if any(seq not in prefixes for seq in gone):
+            return DAFSA.from_sequences(("START",) + seq for seq in sequences), {}, [], True
+
+    if not new_sequences:
+        return dafsa, {}, [], False
+    extended, renumbered, removed = dafsa.insert(new_sequences)
+    return extended, renumbered, removed, False
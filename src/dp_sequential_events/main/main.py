@@ -1,14 +1,21 @@
 
 from dp_sequential_events.main.annotated import DAFSA_annotated_table
+from dp_sequential_events.main.cache import AnnotationCache
 from dp_sequential_events.main.filtered import DAFSA_filtrated
-from dp_sequential_events.main.case_sampling import case_sampling, inject_time_noise, reconstruct_timestamps, compress_timestamps, anonymize_case_ids, clean_final_table
+from dp_sequential_events.main.case_sampling import CaseSample, anonymized_ns, compressed_ns, new_case_ids, pattern_layout, sample_bounds, sorted_cases
 from dp_sequential_events.main.patterns import most_common_patterns
+from dp_sequential_events.main.sweep import parameter_sweep
+from dp_sequential_events.main.event_log import FORMATS, LOG_COLUMNS, XES_COLUMNS, ReadOptions, TableWriter, log_format, read_columns, read_table, write_table
+from dp_sequential_events.main.randomness import random_streams
+from dp_sequential_events.main.streaming import MEMORY_BUDGET, DAFSA_annotated_partitions, DAFSA_filtrated_partitions, Partitions, case_sampling_partitions
 from pathlib import Path
 import pandas as pd
 from datetime import datetime
 import os
-import random
-import sys
+import shutil
+import tempfile
+import time
+import numpy as np
 
 from rich.console import Console
 from rich.table import Table
@@ -19,6 +26,9 @@ from InquirerPy import inquirer
 
 console = Console()
 
+# Annotated tables of earlier runs, None when the cache is bypassed
+annotation_cache = AnnotationCache()
+
 # --- UTILS ----
 def get_user_input(patterns=False):
     while True:
@@ -26,8 +36,7 @@ def get_user_input(patterns=False):
             dataset_name = input("\nEnter dataset path: ").strip()
             if not Path(dataset_name).is_file():
                 raise ValueError("File does not exist. Please try again.")
-            if not dataset_name.endswith(".csv"):
-                raise ValueError("Dataset must be a CSV file")
+            log_format(dataset_name)
             
             delta = float(input("Enter delta value (0-1): "))
             if not (0 <= delta < 1):
@@ -53,12 +62,90 @@ def get_user_input(patterns=False):
         except ValueError as e:
             console.print(f"[bold red]Invalid input: {e}. Please try again.[/bold red]")
 
-def print_table(df, title=None):
+def get_sweep_input():
+    while True:
+        try:
+            dataset_name = input("\nEnter dataset path: ").strip()
+            if not Path(dataset_name).is_file():
+                raise ValueError("File does not exist. Please try again.")
+            log_format(dataset_name)
+
+            deltas = [float(v) for v in input("Enter delta values (0-1, comma separated): ").split(",")]
+            if not all(0 <= d < 1 for d in deltas):
+                raise ValueError("Delta values must be between 0 and 1")
+
+            condition_numbers = [float(v) for v in input("Enter condition numbers (0-1, comma separated): ").split(",")]
+            if not all(0 <= c <= 1 for c in condition_numbers):
+                raise ValueError("Condition numbers must be between 0 and 1")
+
+            return dataset_name, deltas, condition_numbers
+
+        except ValueError as e:
+            console.print(f"[bold red]Invalid input: {e}. Please try again.[/bold red]")
+
+def get_memory_budget():
+    while True:
+        try:
+            value = input(f"Enter memory budget in MiB ({MEMORY_BUDGET >> 20}): ").strip()
+            budget = int(value) if value else MEMORY_BUDGET >> 20
+            if budget <= 0:
+                raise ValueError("Memory budget must be positive")
+            return budget << 20
+
+        except ValueError as e:
+            console.print(f"[bold red]Invalid input: {e}. Please try again.[/bold red]")
+
+def get_workers():
+    while True:
+        try:
+            default = os.cpu_count() or 1
+            value = input(f"Enter worker processes for the PK estimation ({default}): ").strip()
+            workers = int(value) if value else default
+            if workers <= 0:
+                raise ValueError("Worker processes must be positive")
+            return workers
+
+        except ValueError as e:
+            console.print(f"[bold red]Invalid input: {e}. Please try again.[/bold red]")
+
+def get_read_options(dataset_name):
+    # Column mapping and timestamp format of a log that does not use the standard names
+    columns = read_columns(dataset_name)
+    engine = "pyarrow" if has_pyarrow() else "c"
+    if all(col in columns for col in LOG_COLUMNS):
+        return ReadOptions(engine=engine)
+    if all(src in columns for src in XES_COLUMNS):
+        return ReadOptions(columns=XES_COLUMNS, engine=engine)
+
+    guess = {name: src for src, name in XES_COLUMNS.items() if src in columns}
+    while True:
+        try:
+            mapping = {}
+            for col in LOG_COLUMNS:
+                src = text_input(f"Column with the {col}", guess.get(col, col)).strip()
+                if src not in columns:
+                    raise ValueError(f"Column '{src}' not found in the dataset")
+                mapping[src] = col
+
+            timestamp_format = text_input("Timestamp format (empty to infer it)", "").strip() or None
+            return ReadOptions(columns=mapping, timestamp_format=timestamp_format, engine=engine)
+
+        except ValueError as e:
+            console.print(f"[bold red]Invalid input: {e}. Please try again.[/bold red]")
+
+def has_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        return False
+    return True
+
+def print_table(df, title=None, max_rows=10):
     table = Table(title=title, box=box.ROUNDED, show_lines=True)
     for col in df.columns:
         table.add_column(str(col), justify="center")
 
-    for row in df.head(10).itertuples(index=False):
+    for row in df.head(max_rows).itertuples(index=False):
         table.add_row(*[str(x) for x in row])
     
     console.print(table)
@@ -152,7 +239,7 @@ def is_colab():
     except ImportError:
         return False
 
-def export_csv(df):
+def ask_output_path(prefix="anonymized_log"):
     default_folder = get_downloads_folder()
 
     folder = text_input(
@@ -164,36 +251,57 @@ def export_csv(df):
     folder_path = Path(folder)
     folder_path.mkdir(parents=True, exist_ok=True)
 
-    default_name = f"anonymized_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+    default_name = f"{prefix}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
 
-    filename = text_input("Enter filename:", default_name)
+    filename = text_input(f"Enter filename ({', '.join(FORMATS)}):", default_name)
 
-    if not filename.endswith(".csv"):
+    if os.path.splitext(filename)[1].lower() not in FORMATS:
         filename += ".csv"
 
-    full_path = folder_path / filename
+    return folder_path / filename
 
-    df.to_csv(full_path, index=False)
+def export_table(df, prefix="anonymized_log"):
+    full_path = ask_output_path(prefix)
+
+    # Partitioned results are appended one partition at a time
+    if isinstance(df, Partitions):
+        df.to_file(full_path)
+    else:
+        write_table(df, full_path)
 
     console.print(f"\n[bold green]✔ File saved at:[/] {full_path.resolve()}")
 
 def main_menu():
-    return select_option("Select an option:", ["Run full pipeline", "Run patterns-oriented pipeline", "Exit"])
+    return select_option("Select an option:", ["Run full pipeline", "Run patterns-oriented pipeline", "Run parameter sweep", "Run out-of-core pipeline", "Exit"])
 
 # --- MAIN FUNCTIONS ---
-def annotation_and_filtering(data_name, delta=0.3, condition_number=1, _print=True):
-    # Annotated table 
+def annotation(data_name, _print=True, workers=1):
+    # Annotated table, or the one saved by an earlier run
     if _print:
         console.rule("[bold green]ANNOTATION")
-    with Status("[bold green]Generating DAFSA-annotated table..."):
-        df = DAFSA_annotated_table(data_name)
+    if "PK" in read_columns(data_name):
+        with Status("[bold green]Loading DAFSA-annotated table..."):
+            df = read_table(data_name)
+    else:
+        read_options = get_read_options(data_name)
+        with Status("[bold green]Generating DAFSA-annotated table..."):
+            if annotation_cache is None:
+                df = DAFSA_annotated_table(data_name, read_options=read_options, workers=workers)
+            else:
+                df = annotation_cache.annotated_table(data_name, read_options=read_options, workers=workers)
+        if _print and annotation_cache is not None:
+            console.print(f"[dim]Annotation {annotation_cache.report()}[/dim]")
 
     if _print:
         print_table(df, "Annotated Table")
+    return df
+
+def filtering(df, delta=0.3, condition_number=1, _print=True, workers=1):
+    if _print:
         console.rule("[bold green]FILTERING")
     
     with Status("[bold green]Filtering DAFSA table..."):
-        df_filtered = DAFSA_filtrated(df, delta, condition_number)
+        df_filtered = DAFSA_filtrated(df, delta, condition_number, workers=workers)
         
     if _print:
         print_table(df_filtered, "Filtered Table")
@@ -203,48 +311,198 @@ def annotation_and_filtering(data_name, delta=0.3, condition_number=1, _print=Tr
             f"\n[bold yellow]Cases removed:[/bold yellow] {removed} "
             f"([red]{removed / len(df):.2%}[/red])"
         )
-    return df_filtered
-
-def shift_timestamps(df, max_months, max_days):
-    df = df.copy()
-    df["FinalTimestamp"] = pd.to_datetime(df["FinalTimestamp"])
-
-    seed = random.randrange(sys.maxsize)
-    random.seed(seed)
 
-    series_act = []
-    for _, group in df.groupby("CaseID"):
-        original_timestamp = group["FinalTimestamp"]
-        m = random.randint(0, max_months)
-        d = random.randint(0, max_days)
-        shifted_timestamp = original_timestamp + pd.DateOffset(months=m, days=d)
-        
-        in_december = (original_timestamp.dt.month == 12).any()
-        change_year = (original_timestamp.dt.year != shifted_timestamp.dt.year).any()
-        if in_december or change_year:
-            series_act.append(original_timestamp)
-        else:
-            series_act.append(shifted_timestamp)
-    
-    df["FinalTimestamp"] = pd.concat(series_act)
-    return df
+        pk_groups = df_filtered.attrs.get("pk_groups")
+        if pk_groups:
+            console.print(
+                f"[bold yellow]PK groups reused:[/bold yellow] {pk_groups['reused']} "
+                f"[bold yellow]refit:[/bold yellow] {pk_groups['refit']}"
+            )
+    return df_filtered
 
-def sampling_and_anonymization(df_filtered, months_shift=0, days_shift=0):
+def annotation_and_filtering(data_name, delta=0.3, condition_number=1, _print=True, workers=1):
+    df = annotation(data_name, _print, workers)
+    return filtering(df, delta, condition_number, _print, workers)
+
+DAY_NS = 86_400_000_000_000
+
+# Events per piece of write_anonymized
+EXPORT_ROWS = 1 << 20
+MONTH_DAYS = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+def days_from_civil(year, month, day):
+    # Days since 1970-01-01 of a proleptic Gregorian date, on integer arrays
+    year = year - (month <= 2)
+    era = year // 400
+    yoe = year - era * 400
+    doy = (153 * ((month + 9) % 12) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+def civil_from_days(days):
+    # Inverse of days_from_civil, returns (year, month, day) arrays
+    z = days + 719468
+    era = z // 146097
+    doe = z - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    day = doy - (153 * mp + 2) // 5 + 1
+    month = np.where(mp < 10, mp + 3, mp - 9)
+    year = yoe + era * 400 + (month <= 2)
+    return year, month, day
+
+def _add_months_days_ns(ns, months, days):
+    # Shifted int64 nanoseconds plus the original year and month of every element
+    day_number, time_of_day = np.divmod(ns, DAY_NS)
+    year, month, day = civil_from_days(day_number)
+
+    total = year * 12 + (month - 1) + np.asarray(months)
+    new_year, new_month = total // 12, total % 12 + 1
+
+    leap = ((new_year % 4 == 0) & (new_year % 100 != 0)) | (new_year % 400 == 0)
+    month_days = MONTH_DAYS[new_month - 1] + ((new_month == 2) & leap)
+    new_day = np.minimum(day, month_days)
+
+    shifted_days = days_from_civil(new_year, new_month, new_day) + np.asarray(days)
+    return shifted_days * DAY_NS + time_of_day, year, month
+
+def add_months_days(ts, months, days):
+    # Same as ts + pd.DateOffset(months=months, days=days) element-wise: months first,
+    # clamping the day to the end of the target month, then days
+    ns = np.asarray(ts, dtype="datetime64[ns]").view(np.int64)
+    return _add_months_days_ns(ns, months, days)[0].view("datetime64[ns]")
+
+def shifted_ns(ns, case_codes, n_cases, max_months, max_days, rng=None):
+    # Timestamps (int64 nanoseconds) shifted by a random number of months and days per
+    # case, case_codes numbering the cases (copies apart) of the events
+    rng = np.random.default_rng(rng)
+
+    # One (months, days) draw per case, broadcast to its events
+    months = rng.integers(0, max_months, size=n_cases, endpoint=True)
+    days = rng.integers(0, max_days, size=n_cases, endpoint=True)
+
+    shifted, year, month = _add_months_days_ns(ns, months[case_codes], days[case_codes])
+
+    # Cases with an event in December or that would change year keep their timestamps
+    in_december = month == 12
+    change_year = shifted >= days_from_civil(year + 1, 1, 1) * DAY_NS
+
+    keep = np.bincount(case_codes, weights=in_december | change_year, minlength=n_cases) > 0
+
+    return np.where(keep[case_codes], ns, shifted)
+
+def anonymize(df_filtered, months_shift=0, days_shift=0, seed=None, deterministic_ids=False):
+    # Every noise stage draws from its own stream of seed (an int, a RandomStreams or
+    # None for fresh entropy). Case ids come from a stream too with deterministic_ids,
+    # which makes them reproducible by anyone who knows the seed.
+    streams = random_streams(seed)
+    df, sample = draw_sample(df_filtered, streams)
+    return next(anonymized_pieces(df, sample, months_shift, days_shift, streams, deterministic_ids, piece_rows=None))
+
+def write_anonymized(df_filtered, path, months_shift=0, days_shift=0, seed=None, deterministic_ids=False, seconds=None):
+    # anonymize, written to path piece by piece instead of built in memory. Returns
+    # the number of events and cases written. The time spent building and writing the
+    # pieces is added to the "anonymization" and "write" entries of seconds.
+    start = time.perf_counter()
+    write = 0.0
+    streams = random_streams(seed)
+    df, sample = draw_sample(df_filtered, streams)
+    with TableWriter(path) as writer:
+        for piece in anonymized_pieces(df, sample, months_shift, days_shift, streams, deterministic_ids):
+            t = time.perf_counter()
+            writer.write(piece)
+            write += time.perf_counter() - t
+
+    if seconds is not None:
+        seconds["anonymization"] = seconds.get("anonymization", 0.0) + time.perf_counter() - start - write
+        seconds["write"] = seconds.get("write", 0.0) + write
+    return sample.n_events, sample.n_instances
+
+def draw_sample(df_filtered, seed=None, epsilon_d=1):
+    # Sorted table and the cases sampled from it, kept as multiplicities
+    df, index = sorted_cases(df_filtered)
+    sample = CaseSample.draw(index, pattern_layout(index), epsilon_d, random_streams(seed).generator("sampling"))
+    return df, sample
+
+def anonymized_pieces(df, sample, months_shift=0, days_shift=0, seed=None, deterministic_ids=False, piece_rows=EXPORT_ROWS, bounds=None):
+    # Anonymized events of a sample of df, sorted by case and time, in pieces of about
+    # piece_rows events (all in one with None), at least one even when the sample is
+    # empty so that its file still gets written. Noise, timestamps and shifts are
+    # computed for the (case, copy) instances over the rows of df, and the output rows
+    # are only built here, one piece at a time. Timestamps are compressed to the
+    # sample_bounds of the sample, or to bounds for a sample that is part of a larger one.
+    streams = random_streams(seed)
+    anon = anonymized_ns(df, sample, streams.generator("time_noise"))
+
+    if sample.n_events:
+        anon = compressed_ns(anon, sample_bounds(df, sample, anon) if bounds is None else bounds)
+
+    final = shifted_ns(anon, sample.instance, sample.n_instances, months_shift, days_shift, streams.generator("shift"))
+    del anon
+
+    # Copies sorted by their new id, then the events of every piece by time within
+    # their copy (the shift clamps days, so it can reorder them)
+    new_ids = np.array(new_case_ids(sample.n_instances, streams.generator("case_ids") if deterministic_ids else None), dtype=object)
+    order = np.argsort(new_ids)
+    sizes = sample.sizes[order]
+    ends = np.cumsum(sizes)
+
+    activity = df["Activity"].astype("category")
+    activity_codes, activities = activity.cat.codes.to_numpy(), np.asarray(activity.cat.categories, dtype=object)
+
+    if piece_rows is None:
+        bounds = np.array([0, len(order)])
+    else:
+        bounds = np.unique(np.concatenate([[0], np.searchsorted(ends, np.arange(piece_rows, sample.n_events, piece_rows)), [len(order)]]))
+        if len(bounds) == 1:
+            bounds = np.array([0, 0])
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        piece_sizes = sizes[lo:hi]
+        piece_starts = ends[lo:hi] - piece_sizes - (ends[lo - 1] if lo else 0)
+        events = np.repeat(sample.offsets[order[lo:hi]] - piece_starts, piece_sizes) + np.arange(piece_sizes.sum())
+        events = events[np.lexsort((final[events], np.repeat(np.arange(hi - lo), piece_sizes)))]
+        piece_ns = final[events]
+        yield pd.DataFrame({
+            "CaseID": np.repeat(new_ids[order[lo:hi]], piece_sizes),
+            "Activity": activities[activity_codes[sample.rows[events]]],
+            "Timestamp": (piece_ns - piece_ns % 1_000_000_000).view("datetime64[ns]"),
+        }).astype({"CaseID": str, "Activity": str})
+
+def sampling_and_anonymization(df_filtered, months_shift=0, days_shift=0, seed=None):
     with Status("[bold green]Sampling cases..."):
-        df_sampled, duplication_counter = case_sampling(df_filtered)
-        df_noisy = inject_time_noise(df_sampled, duplication_counter)
-        df_reconstructed = reconstruct_timestamps(df_noisy)
-        df_compressed = compress_timestamps(df_reconstructed)
-
-        df_shifted = shift_timestamps(df_compressed, months_shift, days_shift)
-        
-        # Anonymize Case IDs
-        df_final = anonymize_case_ids(df_shifted)
-        df_final = df_final.sort_values("FinalTimestamp").reset_index(drop=True)
+        return anonymize(df_filtered, months_shift, days_shift, seed)
 
-    return clean_final_table(df_final)
+def sampling_and_anonymization_partitions(parts, months_shift=0, days_shift=0, seed=None, deterministic_ids=False):
+    # sampling_and_anonymization over partitions, every step after the global sampling
+    # plan works on one partition at a time, with its own random streams
+    streams = random_streams(seed)
+    with Status("[bold green]Sampling cases..."):
+        draws, bounds = case_sampling_partitions(parts, seed=streams)
+        final = Partitions.create(os.path.join(os.path.dirname(parts.directory), "final"), max(1, len(parts)))
+
+        # Without partitions the output is one empty partition, so that the final log
+        # still gets written with its header like an empty sample of the in-memory path
+        if not draws:
+            final.write(0, pd.DataFrame({
+                "CaseID": pd.Series(dtype=str),
+                "Activity": pd.Series(dtype=str),
+                "Timestamp": pd.Series(dtype="datetime64[ns]"),
+            }))
+
+        for i, (removed, duplicates) in enumerate(draws):
+            df, index = sorted_cases(parts.read(i))
+            sample = CaseSample(index.offsets[:-1], index.sizes, removed, duplicates)
+            pieces = anonymized_pieces(df, sample, months_shift, days_shift, streams.child(i), deterministic_ids, piece_rows=None, bounds=bounds)
+            final.write(i, next(pieces))
+
+    return final
+
+def main(use_cache=True):
+    global annotation_cache
+    if not use_cache:
+        annotation_cache = None
 
-def main():
     while True:
         console.clear()
         
@@ -254,27 +512,41 @@ def main():
             pipeline()
         elif choice == "Run patterns-oriented pipeline":
             patterns()
+        elif choice == "Run parameter sweep":
+            sweep()
+        elif choice == "Run out-of-core pipeline":
+            out_of_core()
         else:
             break
 
 def pipeline():
+    annotated = {}
+    workers = get_workers()
     while True:
         dataset_name, delta, condition_number, months, days = get_user_input()
 
-        df = annotation_and_filtering(dataset_name, delta, condition_number)
+        # The annotation does not depend on delta, retries on the same log reuse it
+        if dataset_name not in annotated:
+            annotated = {dataset_name: annotation(dataset_name, workers=workers)}
+        df = filtering(annotated[dataset_name], delta, condition_number, workers=workers)
         choice = select_option("\nDo you want to try other values?", ["Yes", "No"])
         if choice == "No":
             break
 
+    save = select_option("\nDo you want to save the annotated and filtered tables?", ["Yes", "No"])
+    if save == "Yes":
+        export_table(annotated[dataset_name], prefix="annotated_table")
+        export_table(df, prefix="filtered_table")
+
     df = sampling_and_anonymization(df, months, days)
 
     console.rule("[bold green]FINAL OUTPUT")
     print_table(df, "Final Anonymized Log")
 
-    save = select_option("\nDo you want to save the final CSV?", ["Yes", "No"])
+    save = select_option("\nDo you want to save the final log?", ["Yes", "No"])
 
     if save == "Yes":
-        export_csv(df)
+        export_table(df)
 
     console.print("\n[dim]Press ENTER to return to menu...[/dim]")
     input()
@@ -283,8 +555,9 @@ def pipeline():
 def patterns():
 
     dataset_name, delta, condition_number = get_user_input(patterns=True)
+    workers = get_workers()
 
-    df_filtered = annotation_and_filtering(dataset_name, delta, condition_number, False)
+    df_filtered = annotation_and_filtering(dataset_name, delta, condition_number, False, workers)
 
     console.rule("[bold cyan]PATTERNS (ORIGINAL)")
     print_patterns(df_filtered, "\nMost common full patterns in original log:")
@@ -297,5 +570,65 @@ def patterns():
     console.print("\n[dim]Press ENTER to return to menu...[/dim]")
     input()
 
+def sweep():
+    dataset_name, deltas, condition_numbers = get_sweep_input()
+    workers = get_workers()
+
+    df = annotation(dataset_name, False, workers)
+
+    console.rule("[bold cyan]PARAMETER SWEEP")
+    with Status("[bold green]Evaluating parameter grid..."):
+        df_sweep = parameter_sweep(df, deltas, condition_numbers, workers=workers)
+    print_table(df_sweep, "Filtering results per (delta, condition number)", max_rows=len(df_sweep))
+
+    save = select_option("\nDo you want to save the sweep results?", ["Yes", "No"])
+
+    if save == "Yes":
+        export_table(df_sweep, prefix="parameter_sweep")
+
+    console.print("\n[dim]Press ENTER to return to menu...[/dim]")
+    input()
+
+def out_of_core():
+    dataset_name, delta, condition_number, months, days = get_user_input()
+    memory_budget = get_memory_budget()
+    read_options = get_read_options(dataset_name)
+
+    # Partitions of every stage live under one temporary folder, removed at the end
+    directory = tempfile.mkdtemp(prefix="privseq-")
+    try:
+        console.rule("[bold green]ANNOTATION")
+        with Status("[bold green]Generating DAFSA-annotated partitions..."):
+            annotated = DAFSA_annotated_partitions(dataset_name, directory, memory_budget, read_options=read_options)
+        print_table(annotated.read(0), f"Annotated Table (partition 1 of {len(annotated)})")
+
+        console.rule("[bold green]FILTERING")
+        with Status("[bold green]Filtering DAFSA partitions..."):
+            filtered = DAFSA_filtrated_partitions(annotated, delta, condition_number)
+        annotated.remove()
+        print_table(filtered.read(0), f"Filtered Table (partition 1 of {len(filtered)})")
+
+        removed = annotated.meta["n_events"] - filtered.meta["n_events"]
+        console.print(
+            f"\n[bold yellow]Cases removed:[/bold yellow] {removed} "
+            f"([red]{removed / annotated.meta['n_events']:.2%}[/red])"
+        )
+
+        final = sampling_and_anonymization_partitions(filtered, months, days)
+        filtered.remove()
+
+        console.rule("[bold green]FINAL OUTPUT")
+        print_table(final.read(0), f"Final Anonymized Log (partition 1 of {len(final)})")
+
+        save = select_option("\nDo you want to save the final log?", ["Yes", "No"])
+
+        if save == "Yes":
+            export_table(final)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    console.print("\n[dim]Press ENTER to return to menu...[/dim]")
+    input()
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
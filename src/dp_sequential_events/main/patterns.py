@@ -1,22 +1,16 @@
-from collections import Counter
+import numpy as np
 import pandas as pd
 
-def most_common_patterns(df):
-    sequences = []
+from dp_sequential_events.main.variants import VariantIndex
 
-    # Group by CaseID
-    for case_id, group in df.groupby('CaseID'):
-        # Sort by Timestamp to preserve sequence
-        activities = group.sort_values('Timestamp')['Activity'].tolist()
-        # Convert the sequence to a string pattern
-        pattern_str = ''.join(activities)
-        sequences.append(pattern_str)
+def most_common_patterns(df):
+    # Variants of the cases, sorted by Timestamp to preserve the sequence
+    index = VariantIndex.of(df.sort_values(["CaseID", "Timestamp"], kind="stable"))
+    present = np.flatnonzero(index.counts)
 
     # Count frequency of each pattern
-    counter = Counter(sequences)
-
-    # Convert to DataFrame
-    df_patterns = pd.DataFrame(counter.items(), columns=['Pattern', 'Count'])
-    df_patterns = df_patterns.sort_values(by='Count', ascending=False).reset_index(drop=True)
+    labels = np.array(index.labels(), dtype=object)
+    df_patterns = pd.DataFrame({"Pattern": labels[present], "Count": index.counts[present]})
+    df_patterns = df_patterns.sort_values(by='Count', ascending=False, kind="stable").reset_index(drop=True)
 
-    return df_patterns
+    return df_patterns
\ No newline at end of file
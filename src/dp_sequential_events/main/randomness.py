@@ -0,0 +1,36 @@
+import numpy as np
+
+# Every noise stage draws from its own generator, spawned from one SeedSequence by
+# stage and, for partitioned runs, by partition. The draws of a stage do not depend on
+# the other stages, on the order the partitions are processed in or on the number of
+# processes, and the entropy of a run is enough to reproduce it.
+
+STAGES = ("sampling", "time_noise", "shift", "case_ids")
+
+class RandomStreams:
+    def __init__(self, seed=None):
+        # seed is anything SeedSequence takes (None draws fresh OS entropy) or a
+        # SeedSequence
+        if isinstance(seed, np.random.SeedSequence):
+            self.seed_sequence = seed
+        else:
+            self.seed_sequence = np.random.SeedSequence(seed)
+
+    @property
+    def entropy(self):
+        return self.seed_sequence.entropy
+
+    def generator(self, stage, shard=None):
+        if stage not in STAGES:
+            raise ValueError(f"Unknown random stage '{stage}', expected one of {', '.join(STAGES)}")
+        key = (STAGES.index(stage),) if shard is None else (STAGES.index(stage), shard)
+        seq = np.random.SeedSequence(self.entropy, spawn_key=self.seed_sequence.spawn_key + key)
+        return np.random.default_rng(seq)
+
+    def child(self, i):
+        # Streams of the i-th of several independent runs (e.g. the windows of a log),
+        # keyed past the stages so they never meet the generators of this run
+        return RandomStreams(np.random.SeedSequence(self.entropy, spawn_key=self.seed_sequence.spawn_key + (len(STAGES), i)))
+
+def random_streams(seed=None):
+    return seed if isinstance(seed, RandomStreams) else RandomStreams(seed)
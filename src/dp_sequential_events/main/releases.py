@@ -0,0 +1,39 @@
+import os
+
+from dp_sequential_events.main.case_sampling import CaseSample, pattern_layout, sorted_cases
+from dp_sequential_events.main.event_log import FORMATS, write_table
+from dp_sequential_events.main.main import anonymized_pieces
+from dp_sequential_events.main.randomness import random_streams
+
+# Many independent anonymized releases of one filtered table, for utility studies.
+# The sorted table and its patterns are prepared once; every release only draws its
+# sample and noise over the (case, copy) pairs it keeps and builds its own rows, so
+# it costs about the size of its output. Release i is the table anonymize gives with
+# the i-th child of the seed's streams.
+
+def anonymized_releases(df_filtered, k, months_shift=0, days_shift=0, seed=None, deterministic_ids=False, epsilon_d=1):
+    # Generator of the k releases, one at a time
+    streams = random_streams(seed)
+
+    df, index = sorted_cases(df_filtered)
+    layout = pattern_layout(index)
+
+    for i in range(k):
+        release_streams = streams.child(i)
+        sample = CaseSample.draw(index, layout, epsilon_d, release_streams.generator("sampling"))
+        yield next(anonymized_pieces(df, sample, months_shift, days_shift, release_streams, deterministic_ids, piece_rows=None))
+
+def write_releases(releases, directory, fmt="csv"):
+    # Every release of a generator to its own file of directory, release-00000.csv and
+    # so on, without keeping more than one in memory. Returns the paths.
+    if fmt not in FORMATS.values():
+        raise ValueError(f"Unknown output format '{fmt}'")
+    ext = next(ext for ext, name in FORMATS.items() if name == fmt)
+    os.makedirs(directory, exist_ok=True)
+
+    paths = []
+    for i, df in enumerate(releases):
+        path = os.path.join(directory, f"release-{i:05d}{ext}")
+        write_table(df, path)
+        paths.append(path)
+    return paths
@@ -0,0 +1,351 @@
+import math
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from dp_sequential_events.main.annotated import precision
+from dp_sequential_events.main.case_sampling import CaseSample, anonymized_ns, draw_cases, merged_bounds, sample_bounds, sorted_cases, variant_layout
+from dp_sequential_events.main.dafsa import DAFSA
+from dp_sequential_events.main.event_log import TableWriter, count_rows, iter_log
+from dp_sequential_events.main.filtered import epsilon_t, kept_events
+from dp_sequential_events.main.kde import GRID_SIZE, MIN_EVENTS, BinnedGroups, metric_values
+from dp_sequential_events.main.randomness import random_streams
+from dp_sequential_events.main.variants import VariantIndex
+
+# Out-of-core mode for logs larger than memory.
+#
+# Pass 1 streams the log (CSV, Parquet or Feather) in chunks and spills every event to
+# an on-disk partition chosen by a hash of its CaseID, so that each case lives in a
+# single partition and a partition fits in the memory budget. Each partition is then sorted and its
+# variants are merged into the global variant set the DAFSA is built from. Pass 2
+# annotates the partitions one at a time; the group statistics that need the whole
+# log (RelTime range, KDE bins and moments) are accumulated across partitions and
+# applied in a last pass over them; groups with a narrow bandwidth take one more pass,
+# as their density is summed from the events themselves. Filtering and sampling go
+# through the partitions the same way, so no stage holds more than one partition of
+# events.
+#
+# Peak memory is the budget plus the per-group state, which does not grow with the
+# number of events: the DAFSA and a GRID_SIZE float64 grid per transition with enough
+# events to be fitted.
+
+# Default memory budget, in bytes
+MEMORY_BUDGET = 512 << 20
+
+# Rough in-memory cost of one event while a partition is sorted, annotated or sampled,
+# and while a chunk of the log is parsed and split. They size the partitions and chunks.
+PARTITION_ROW_BYTES = 400
+CHUNK_ROW_BYTES = 200
+
+# Smallest chunk of the log, below this the per-chunk overhead dominates
+MIN_CHUNK_ROWS = 1000
+
+class Partitions:
+    # Event table spilled to disk as one pickle per partition, plus the metadata the
+    # next stage needs. Every case lives in a single partition.
+    def __init__(self, directory, n_partitions, meta=None):
+        self.directory = directory
+        self.n_partitions = n_partitions
+        self.meta = {} if meta is None else meta
+
+    @classmethod
+    def create(cls, directory, n_partitions, meta=None):
+        os.makedirs(directory, exist_ok=True)
+        return cls(directory, n_partitions, meta)
+
+    def __len__(self):
+        return self.n_partitions
+
+    def __iter__(self):
+        return (self.read(i) for i in range(len(self)))
+
+    def path(self, i):
+        return os.path.join(self.directory, f"part-{i:05d}.pkl")
+
+    def read(self, i):
+        return pd.read_pickle(self.path(i))
+
+    def write(self, i, df):
+        df.to_pickle(self.path(i))
+
+    def to_frame(self):
+        # Whole table in memory, only for results known to be small
+        return pd.concat(list(self), ignore_index=True)
+
+    def to_file(self, path):
+        # All the partitions in one CSV, Parquet or Feather file
+        with TableWriter(path) as writer:
+            for df in self:
+                writer.write(df)
+
+    def remove(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+def DAFSA_annotated_partitions(nombre_archivo, directory=None, memory_budget=MEMORY_BUDGET, grid_size=GRID_SIZE, read_options=None):
+    # Same table as DAFSA_annotated_table, written to partitions under directory
+    directory = tempfile.mkdtemp(prefix="privseq-") if directory is None else directory
+    n_partitions = max(1, math.ceil(count_rows(nombre_archivo) * PARTITION_ROW_BYTES / memory_budget))
+    chunk_rows = max(MIN_CHUNK_ROWS, memory_budget // CHUNK_ROW_BYTES)
+
+    # 1. Spill the events to the partition of their case
+    spill_dir = os.path.join(directory, "spill")
+    os.makedirs(spill_dir, exist_ok=True)
+    min_ns, pieces = _spill_cases(nombre_archivo, spill_dir, n_partitions, chunk_rows, read_options)
+
+    # 2. Sort every partition and merge its variants into the global variant set
+    nonempty = [i for i in range(n_partitions) if pieces[i]]
+    parts = Partitions.create(os.path.join(directory, "annotated"), len(nonempty))
+    variant_ids = {}
+    local_variants = []
+    n_events = 0
+
+    for j, i in enumerate(nonempty):
+        paths = [os.path.join(spill_dir, f"spill-{i:05d}-{k:05d}.pkl") for k in range(pieces[i])]
+        log = pd.concat([pd.read_pickle(path) for path in paths], ignore_index=True)
+        for path in paths:
+            os.remove(path)
+
+        log = log.sort_values(["CaseID", "Timestamp"]).reset_index(drop=True)
+        log["CaseID"] = log["CaseID"].astype("category")
+        log["Activity"] = log["Activity"].astype("category")
+
+        index = VariantIndex.from_log(log)
+        local_variants.append(np.array(
+            [variant_ids.setdefault(seq, len(variant_ids)) for seq in index.sequences()],
+            dtype=np.int64
+        ))
+        log.attrs["variant_index"] = index
+        parts.write(j, log)
+        n_events += len(log)
+
+    shutil.rmtree(spill_dir, ignore_errors=True)
+
+    # 3. Create the DAFSA from the global variants and walk each of them once
+    variants = list(variant_ids)
+    dafsa = DAFSA.from_sequences(sorted(("START",) + seq for seq in variants))
+
+    after_start = dafsa.next_state(dafsa.start, dafsa.encode(["START"])[0])
+    code = {act: i for i, act in enumerate(dafsa.activities)}
+    paths = [dafsa.walk([code[act] for act in seq], start=after_start) for seq in variants]
+    path_offsets = np.concatenate([[0], np.cumsum([len(p) for p in paths])[:-1]]).astype(np.int64)
+    paths = np.concatenate(paths) if paths else np.zeros(0, dtype=np.int32)
+
+    # 4. States and RelTime of every partition, with the RelTime range of every group
+    n_groups = dafsa.n_transitions
+    rt_min = np.full(n_groups, np.inf)
+    rt_max = np.full(n_groups, -np.inf)
+    sizes = np.zeros(n_groups, dtype=np.int64)
+
+    for i in range(len(parts)):
+        log = parts.read(i)
+        index = VariantIndex.of(log)
+        pos = path_offsets[local_variants[i][index.event_variant()]] + index.event_step()
+
+        ns = log["Timestamp"].values.view(np.int64)
+        first = index.offsets[:-1]
+        rel = np.empty(len(ns))
+        rel[1:] = np.diff(ns) / 60e9
+        rel[first] = (ns[first] - min_ns) / 86400e9
+
+        df = pd.DataFrame({
+            "CaseID": log["CaseID"],
+            "Activity": log["Activity"],
+            "Timestamp": log["Timestamp"],
+            "SrcState": paths[pos],
+            "TgtState": paths[pos + 1],
+            "RelTime": rel,
+        })
+        df.attrs["variant_index"] = index
+
+        groups = _groups(dafsa, df)
+        np.minimum.at(rt_min, groups, rel)
+        np.maximum.at(rt_max, groups, rel)
+        sizes += np.bincount(groups, minlength=n_groups)
+        parts.write(i, df)
+
+    # 5. KDE bins of every group large enough to be fitted, accumulated over the
+    # partitions
+    binned = BinnedGroups(n_groups, grid_size, sizes >= MIN_EVENTS)
+    for df in parts:
+        groups = _groups(dafsa, df)
+        binned.add(_normalize(df, groups, rt_min, rt_max)[0], groups)
+    if binned.narrow().any():
+        for df in parts:
+            groups = _groups(dafsa, df)
+            binned.refine(_normalize(df, groups, rt_min, rt_max)[0], groups)
+    binned.finish()
+
+    # 6. NrmRelTime, Prec and PK, with the fallback of estimate_pk_table's delta, and
+    # the KDE of the rounded NrmRelTime DAFSA_filtrated keeps as pk_refit
+    refit = BinnedGroups(n_groups, grid_size, sizes >= MIN_EVENTS)
+    for i in range(len(parts)):
+        df = parts.read(i)
+        groups = _groups(dafsa, df)
+        df["NrmRelTime"], df["Prec"] = _normalize(df, groups, rt_min, rt_max)
+
+        pk = binned.pk(df["NrmRelTime"].values, df["Prec"].values, groups)
+        pk[np.isnan(pk)] = (1 - 0.3) / 2
+        df["PK"] = pk
+
+        df["RelTime"] = df["RelTime"].round(2)
+        metric_cols = ["NrmRelTime", "Prec", "PK"]
+        df[metric_cols] = df[metric_cols].round(2).astype(np.float32)
+        refit.add(metric_values(df, "NrmRelTime"), groups)
+        parts.write(i, df)
+
+    if refit.narrow().any():
+        for df in parts:
+            refit.refine(metric_values(df, "NrmRelTime"), _groups(dafsa, df))
+
+    parts.meta = {
+        "dafsa": dafsa,
+        "pk_refit": refit.finish(),
+        "local_variants": local_variants,
+        "n_variants": len(variants),
+        "n_events": n_events,
+    }
+    return parts
+
+def DAFSA_filtrated_partitions(parts, delta=0.3, condition_number=1, directory=None, grid_size=GRID_SIZE):
+    # Same table as DAFSA_filtrated, from and to partitions
+    directory = os.path.dirname(parts.directory) if directory is None else directory
+    out = Partitions.create(os.path.join(directory, "filtered"), len(parts), dict(parts.meta))
+    dafsa = parts.meta["dafsa"]
+    refit_state = parts.meta["pk_refit"]
+    n_groups = dafsa.n_transitions
+
+    # 1. Groups that lose events to the risky cases, and their surviving sizes
+    dirty = np.zeros(n_groups, dtype=bool)
+    sizes = np.zeros(n_groups, dtype=np.int64)
+    for df in parts:
+        groups = _groups(dafsa, df)
+        keep = kept_events(df, delta, condition_number)
+        dirty[groups[~keep]] = True
+        sizes += np.bincount(groups[keep], minlength=n_groups)
+
+    # 2. KDE bins of the dirty groups over the surviving events, the others take their
+    # New PK from the annotation's pk_refit
+    binned = BinnedGroups(n_groups, grid_size, dirty & (sizes >= MIN_EVENTS))
+    if dirty.any():
+        for df in parts:
+            groups = _groups(dafsa, df)
+            rows = kept_events(df, delta, condition_number) & dirty[groups]
+            binned.add(metric_values(df, "NrmRelTime")[rows], groups[rows])
+    if binned.narrow().any():
+        for df in parts:
+            groups = _groups(dafsa, df)
+            rows = kept_events(df, delta, condition_number) & dirty[groups]
+            binned.refine(metric_values(df, "NrmRelTime")[rows], groups[rows])
+    binned.finish()
+
+    # 3. New PK and ϵt of every partition
+    reused = np.zeros(n_groups, dtype=bool)
+    refit = np.zeros(n_groups, dtype=bool)
+    n_events = 0
+
+    for i, df_annotated in enumerate(parts):
+        keep = kept_events(df_annotated, delta, condition_number)
+        groups = _groups(dafsa, df_annotated)[keep]
+
+        df = df_annotated[keep].copy()
+        index = VariantIndex.of(df_annotated)
+        df.attrs["variant_index"] = index.subset(keep[index.offsets[:-1]])
+
+        t = metric_values(df, "NrmRelTime")
+        prec = metric_values(df, "Prec")
+        new_pk = np.where(dirty[groups], binned.pk(t, prec, groups), refit_state.pk(t, prec, groups))
+        new_pk[np.isnan(new_pk)] = (1 - delta) / 2
+
+        rows = np.flatnonzero(dirty[groups])
+
+        reused[groups[~dirty[groups]]] = True
+        refit[groups[rows]] = True
+
+        df["New PK"] = new_pk
+        df = df.reset_index(drop=True)
+        df = df.drop(columns=["PK"])
+
+        df["ϵt"] = epsilon_t(df["New PK"].values, delta)
+        df = df.drop(columns=["Prec", "NrmRelTime"])
+
+        metric_cols = ["New PK", "ϵt"]
+        df[metric_cols] = df[metric_cols].round(2).astype(np.float32)
+        out.write(i, df)
+        n_events += len(df)
+
+    out.meta.pop("pk_refit")
+    out.meta["n_events"] = n_events
+    out.meta["pk_groups"] = {"reused": int(reused.sum()), "refit": int(refit.sum())}
+    return out
+
+def case_sampling_partitions(parts, epsilon_d=1, seed=None):
+    # draw_sample over all the partitions: one draw of noisy pattern counts over their
+    # cases, in partition then CaseID order, split into the removed and duplicates of
+    # the CaseSample of every partition's sorted_cases. Also returns the timestamp
+    # bounds of the whole sample (None when it has no events), the time noise of
+    # partition i drawing from streams.child(i) as when it is exported.
+    streams = random_streams(seed)
+    local_variants = parts.meta["local_variants"]
+
+    # 1. Global variant of every case, the draw and its share of every partition
+    variants = [local_variants[i][sorted_cases(df)[1].variant] for i, df in enumerate(parts)]
+    variant = np.concatenate([np.zeros(0, dtype=np.int64)] + variants)
+    counts = np.bincount(variant, minlength=parts.meta["n_variants"])
+    removed, dup_cases = draw_cases(variant_layout(variant, counts), epsilon_d, streams.generator("sampling"))
+    duplicates = np.bincount(dup_cases, minlength=len(variant))
+
+    ends = np.cumsum([len(v) for v in variants], dtype=np.int64)
+    draws = [(removed[end - len(v):end], duplicates[end - len(v):end]) for v, end in zip(variants, ends)]
+    del variants, variant, removed, duplicates
+
+    # 2. Bounds of the anonymized timestamps, partition by partition
+    bounds = None
+    for i, df in enumerate(parts):
+        df, index = sorted_cases(df)
+        sample = CaseSample(index.offsets[:-1], index.sizes, *draws[i])
+        anon = anonymized_ns(df, sample, streams.child(i).generator("time_noise"))
+        bounds = merged_bounds(bounds, sample_bounds(df, sample, anon))
+
+    return draws, bounds
+
+def _spill_cases(path, spill_dir, n_partitions, chunk_rows, read_options):
+    # Pass 1: stream the log and write every chunk's events to the partition of their
+    # case. Returns the earliest timestamp and the number of pieces per partition.
+    pieces = [0] * n_partitions
+    min_ns = None
+
+    for chunk in iter_log(path, chunk_rows, read_options):
+        chunk["Activity"] = chunk["Activity"].astype(str)
+
+        ns = chunk["Timestamp"].values.view(np.int64)
+        min_ns = ns.min() if min_ns is None else min(min_ns, ns.min())
+
+        # Hash of the CaseID string, so that it does not depend on the dtype of a chunk
+        bucket = pd.util.hash_array(chunk["CaseID"].astype(str).to_numpy(dtype=object)) % np.uint64(n_partitions)
+        order = np.argsort(bucket, kind="stable")
+        bounds = np.searchsorted(bucket[order], np.arange(n_partitions + 1, dtype=np.uint64))
+
+        for i in range(n_partitions):
+            if bounds[i] < bounds[i + 1]:
+                piece = chunk.take(order[bounds[i]:bounds[i + 1]])
+                piece.to_pickle(os.path.join(spill_dir, f"spill-{i:05d}-{pieces[i]:05d}.pkl"))
+                pieces[i] += 1
+
+    return min_ns, pieces
+
+def _groups(dafsa, df):
+    # Transition of every event, the (SrcState, Activity, TgtState) group id shared by
+    # all the partitions
+    return dafsa.table_edges(df)
+
+def _normalize(df, groups, rt_min, rt_max):
+    # NrmRelTime and Prec from the RelTime range of every group
+    rel = df["RelTime"].values
+    min_rt, max_rt = rt_min[groups], rt_max[groups]
+    range_rt = max_rt - min_rt
+
+    nrm = np.where(range_rt == 0, 0.0, (rel - min_rt) / np.where(range_rt == 0, 1, range_rt))
+    return nrm, precision(rel, min_rt, max_rt)
@@ -0,0 +1,96 @@
+import hashlib
+from itertools import product
+
+import numpy as np
+import pandas as pd
+
+from dp_sequential_events.main.filtered import epsilon_t
+from dp_sequential_events.main.kde import GRID_SIZE, fit_pk, group_ids, metric_values
+from dp_sequential_events.main.variants import VariantIndex
+
+# Evaluate DAFSA_filtrated over a grid of (delta, condition_number) pairs on a single
+# annotated table. Only the risky-case selection, the refit of the groups whose
+# surviving membership is new, and ϵt depend on the parameters; KDE fits are cached
+# per (group, surviving rows) and reused by every pair that leaves that group alike.
+
+def parameter_sweep(df_annotated, deltas, condition_numbers, grid_size=GRID_SIZE, workers=1):
+    group_cols = ["SrcState", "Activity", "TgtState"]
+
+    # Parameter independent parts, computed once for the whole grid
+    case_codes, case_ids = pd.factorize(df_annotated["CaseID"])
+    index = VariantIndex.of(df_annotated)
+    variant_of_case = index.variant
+    n_variants = np.count_nonzero(index.counts)
+
+    groups = group_ids(df_annotated, group_cols)
+    pk = metric_values(df_annotated, "PK")
+    t = metric_values(df_annotated, "NrmRelTime")
+    prec = metric_values(df_annotated, "Prec")
+
+    cache = {}
+    results = []
+
+    for delta, condition_number in product(deltas, condition_numbers):
+        # 1. Same risky-case rule as DAFSA_filtrated
+        risky = np.zeros(len(case_ids), dtype=bool)
+        risky[case_codes[pk + delta >= condition_number]] = True
+        rows = np.flatnonzero(~risky[case_codes])
+
+        # 2. New PK, reusing the fits of groups whose surviving rows were seen before
+        new_pk, reused, refit = _cached_pk(cache, rows, groups[rows], t, prec, grid_size, workers)
+        new_pk[np.isnan(new_pk)] = (1 - delta) / 2
+
+        # 3. ϵt and pattern retention for the surviving cases
+        eps = epsilon_t(new_pk, delta)
+        kept_variants = np.unique(variant_of_case[~risky])
+
+        results.append({
+            "Delta": delta,
+            "Condition number": condition_number,
+            "Cases removed": int(risky.sum()),
+            "Cases removed (%)": 100 * risky.mean() if len(risky) else 0.0,
+            "Events removed": len(df_annotated) - len(rows),
+            "ϵt mean": eps.mean() if len(eps) else np.nan,
+            "ϵt median": np.median(eps) if len(eps) else np.nan,
+            "ϵt max": eps.max() if len(eps) else np.nan,
+            "Patterns retained (%)": 100 * len(kept_variants) / n_variants if n_variants else 0.0,
+            "Groups reused": reused,
+            "Groups refit": refit,
+        })
+
+    df = pd.DataFrame(results)
+    numeric_cols = df.select_dtypes(include=[np.number]).columns
+    df[numeric_cols] = df[numeric_cols].round(4)
+
+    return df
+
+def _cached_pk(cache, rows, row_groups, t, prec, grid_size, workers):
+    # Fitted PK (NaN for fallback groups) of the given rows, looked up per group by the
+    # exact set of surviving rows and fitted in one batched call for the new ones
+    new_pk = np.empty(len(rows))
+    order = np.argsort(row_groups, kind="stable")
+    bounds = np.flatnonzero(np.diff(row_groups[order])) + 1
+    slices = np.split(order, bounds) if len(order) else []
+
+    pending = []
+    for pos in slices:
+        members = rows[pos]
+        key = (row_groups[pos[0]], hashlib.blake2b(members.tobytes(), digest_size=16).digest())
+        hit = cache.get(key)
+        if hit is None:
+            pending.append((key, pos))
+        else:
+            new_pk[pos] = hit
+
+    if pending:
+        sel = np.concatenate([pos for _, pos in pending])
+        local = np.repeat(np.arange(len(pending)), [len(pos) for _, pos in pending])
+        fitted = fit_pk(t[rows[sel]], prec[rows[sel]], local, grid_size=grid_size, workers=workers)
+        new_pk[sel] = fitted
+
+        start = 0
+        for key, pos in pending:
+            cache[key] = fitted[start:start + len(pos)]
+            start += len(pos)
+
+    return new_pk, len(slices) - len(pending), len(pending)
@@ -0,0 +1,180 @@
+import numpy as np
+import pandas as pd
+
+# Odd 64-bit multipliers of the two polynomial hashes of a coded sequence. Variants
+# are keyed by (length, hash1, hash2), i.e. 128 bits of hash plus the length.
+HASH_BASES = (np.uint64(0x9E3779B97F4A7C15), np.uint64(0xC2B2AE3D27D4EB4F))
+
+class VariantIndex:
+    # Integer-coded variants of a log whose cases are contiguous and time ordered:
+    # activity codes per event, case start offsets, a variant id per case and the
+    # number of cases of every variant. Variant ids follow first appearance and the
+    # coded sequence of every variant is kept in variant_codes/variant_offsets.
+    def __init__(self, case_ids, offsets, codes, activities, variant, counts,
+                 variant_codes=None, variant_offsets=None):
+        self.case_ids = case_ids
+        self.offsets = offsets
+        self.codes = codes
+        self.activities = activities
+        self.variant = variant
+        self.counts = counts
+        self.variant_codes = variant_codes
+        self.variant_offsets = variant_offsets
+
+    # The index is never modified in place, so copies of a frame (and of its attrs)
+    # can share it
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    @classmethod
+    def from_log(cls, log):
+        case_codes = _codes(log["CaseID"])
+        n_events = len(case_codes)
+
+        starts = np.flatnonzero(np.concatenate([[True], case_codes[1:] != case_codes[:-1]])) if n_events else np.zeros(0, dtype=np.int64)
+        case_ids = log["CaseID"].iloc[starts].to_numpy()
+        if len(np.unique(case_codes[starts])) != len(starts):
+            raise ValueError("Log must be sorted by CaseID")
+
+        offsets = np.append(starts, n_events).astype(np.int64)
+        codes, activities = _factorize_labels(log["Activity"])
+
+        index = cls(case_ids, offsets, codes, activities, None, None)
+        index.variant = index._hash_variants()
+        index.counts = np.bincount(index.variant) if len(index.variant) else np.zeros(0, dtype=np.int64)
+
+        # Sequence of every variant, taken from its first case
+        first = np.unique(index.variant, return_index=True)[1]
+        sizes = index.sizes[first]
+        index.variant_offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        index.variant_codes = codes[_ranges(offsets[first], sizes)]
+        return index
+
+    @classmethod
+    def of(cls, df):
+        # Index attached to the frame by an earlier stage, or a fresh one
+        index = df.attrs.get("variant_index")
+        if index is not None and index.matches(df):
+            return index
+        return cls.from_log(df)
+
+    @property
+    def n_cases(self):
+        return len(self.case_ids)
+
+    @property
+    def n_events(self):
+        return int(self.offsets[-1])
+
+    @property
+    def n_variants(self):
+        return len(self.counts)
+
+    @property
+    def sizes(self):
+        return np.diff(self.offsets)
+
+    def matches(self, df):
+        if len(df) != self.n_events:
+            return False
+        # Case boundaries, then the activity of every event in the codes of the index,
+        # so that an edit keeping the case lengths (relabelled activities) is caught.
+        # Categorical columns stay coded, only their categories are looked up.
+        case_col = df["CaseID"]
+        return (
+            np.array_equal(case_col.iloc[self.offsets[:-1]].to_numpy(), self.case_ids)
+            and np.array_equal(case_col.iloc[self.offsets[1:] - 1].to_numpy(), self.case_ids)
+            and np.array_equal(_activity_codes(df["Activity"], self.activities), self.codes)
+        )
+
+    def event_variant(self):
+        return np.repeat(self.variant, self.sizes)
+
+    def event_step(self):
+        # Position of every event inside its case
+        return _ranges(np.zeros(self.n_cases, dtype=np.int64), self.sizes)
+
+    def sequence_codes(self, v):
+        return self.variant_codes[self.variant_offsets[v]:self.variant_offsets[v + 1]]
+
+    def sequences(self):
+        # Activity labels of every variant, as tuples
+        return [tuple(self.activities[self.sequence_codes(v)]) for v in range(self.n_variants)]
+
+    def labels(self):
+        # Pattern strings. Single-character activities are concatenated as before,
+        # longer names are separated so that the pattern stays unambiguous.
+        sep = "" if all(len(act) == 1 for act in self.activities) else " > "
+        return [sep.join(seq) for seq in self.sequences()]
+
+    def subset(self, keep_cases):
+        # Index of the kept cases (boolean mask over cases), variant ids unchanged
+        keep_cases = np.asarray(keep_cases, dtype=bool)
+        sizes = self.sizes[keep_cases]
+        variant = self.variant[keep_cases]
+
+        return VariantIndex(
+            self.case_ids[keep_cases],
+            np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64),
+            self.codes[_ranges(self.offsets[:-1][keep_cases], sizes)],
+            self.activities,
+            variant,
+            np.bincount(variant, minlength=self.n_variants),
+            self.variant_codes,
+            self.variant_offsets
+        )
+
+    def _hash_variants(self):
+        if self.n_cases == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        step = self.event_step()
+        symbols = self.codes.astype(np.uint64) + np.uint64(1)
+
+        keys = [self.sizes]
+        with np.errstate(over="ignore"):
+            for base in HASH_BASES:
+                powers = np.full(step.max() + 1, base, dtype=np.uint64)
+                powers[0] = 1
+                powers = np.cumprod(powers)
+                keys.append(np.add.reduceat(symbols * powers[step], self.offsets[:-1]))
+
+        return pd.MultiIndex.from_arrays(keys).factorize()[0].astype(np.int64)
+
+def _codes(col):
+    # Integer codes of a column, read directly from a categorical
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        return col.cat.codes.to_numpy()
+    return pd.factorize(col)[0]
+
+def _factorize_labels(col):
+    # int32 codes of the observed labels, numbered in sorted string order
+    codes, labels = pd.factorize(col, sort=True)
+    labels = np.asarray(labels, dtype=object).astype(str).astype(object)
+    order = np.argsort(labels, kind="stable")
+    rank = np.empty(len(order), dtype=np.int32)
+    rank[order] = np.arange(len(order), dtype=np.int32)
+    return rank[codes], labels[order]
+
+def _activity_codes(col, activities):
+    # Codes of a column in the sorted labels of an index, -1 for the labels it lacks
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        codes, labels = col.cat.codes.to_numpy(), col.cat.categories
+    else:
+        codes, labels = pd.factorize(col)
+    labels = np.asarray(labels, dtype=object).astype(str).astype(object)
+
+    pos = np.minimum(np.searchsorted(activities, labels), max(len(activities) - 1, 0))
+    found = (activities[pos] == labels) if len(activities) else np.zeros(len(labels), dtype=bool)
+    # The trailing -1 is looked up by missing values (code -1)
+    lookup = np.append(np.where(found, pos, -1), -1)
+    return lookup[codes]
+
+def _ranges(starts, sizes):
+    # Concatenation of range(start, start + size) for every pair, without a Python loop
+    sizes = np.asarray(sizes, dtype=np.int64)
+    ends = np.cumsum(sizes)
+    return np.repeat(np.asarray(starts, dtype=np.int64) - (ends - sizes), sizes) + np.arange(ends[-1] if len(ends) else 0)
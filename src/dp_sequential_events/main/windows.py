@@ -0,0 +1,130 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from dp_sequential_events.main.annotated import precision
+from dp_sequential_events.main.filtered import DAFSA_filtrated
+from dp_sequential_events.main.kde import GRID_SIZE, batched_pk, metric_values, refit_state
+from dp_sequential_events.main.main import anonymize
+from dp_sequential_events.main.randomness import random_streams
+from dp_sequential_events.main.variants import VariantIndex
+
+# Periodic releases of one log (monthly extracts, ...). Every case belongs to the time
+# window of its first event. The log is annotated once and all the windows share its
+# DAFSA, so a state has the same number in every release; each window then measures
+# its first events from its own start, normalizes and fits PK over its own events and
+# is filtered, sampled and anonymized on its own, the windows in parallel. The whole
+# log's metrics are not used, so it can be annotated with metrics=False.
+
+# pandas period frequency of the windows
+WINDOW_FREQ = "M"
+
+def case_windows(df, freq=WINDOW_FREQ):
+    # Window of every case of a (CaseID, Timestamp) sorted table, as a PeriodIndex
+    index = VariantIndex.of(df)
+    first = df["Timestamp"].to_numpy("datetime64[ns]")[index.offsets[:-1]]
+    return pd.DatetimeIndex(first).to_period(freq)
+
+def split_windows(df_annotated, freq=WINDOW_FREQ):
+    # [(period, rows of its cases)] in time order. The rows keep the table's order and
+    # come with their variant index and the shared DAFSA, but without the metrics
+    # window_table computes again, nor the whole log's pk_refit.
+    index = VariantIndex.of(df_annotated)
+    dafsa = df_annotated.attrs["dafsa"]
+    columns = ["CaseID", "Activity", "Timestamp", "SrcState", "TgtState"]
+    codes, periods = pd.factorize(case_windows(df_annotated, freq), sort=True)
+
+    event_window = np.repeat(codes, index.sizes)
+    order = np.argsort(event_window, kind="stable")
+    bounds = np.searchsorted(event_window[order], np.arange(len(periods) + 1))
+
+    windows = []
+    for w, period in enumerate(periods):
+        df = df_annotated[columns].take(order[bounds[w]:bounds[w + 1]]).reset_index(drop=True)
+        df["CaseID"] = df["CaseID"].cat.remove_unused_categories()
+        df.attrs = {"variant_index": index.subset(codes == w), "dafsa": dafsa}
+        windows.append((period, df))
+    return windows
+
+def window_table(df, grid_size=GRID_SIZE, workers=1):
+    # Annotated table of one window: what DAFSA_annotated_table gives for its cases,
+    # but with the states of the shared DAFSA
+    df = df.copy()
+    dafsa = df.attrs["dafsa"]
+    index = VariantIndex.of(df)
+
+    ns = df["Timestamp"].values.view(np.int64)
+    first = index.offsets[:-1]
+    rel = np.empty(len(ns))
+    rel[1:] = np.diff(ns) / 60e9
+    rel[first] = (ns[first] - ns.min()) / 86400e9 if len(ns) else 0
+
+    groups = dafsa.table_edges(df)
+    min_rt = np.full(dafsa.n_transitions, np.inf)
+    max_rt = np.full(dafsa.n_transitions, -np.inf)
+    np.minimum.at(min_rt, groups, rel)
+    np.maximum.at(max_rt, groups, rel)
+    min_rt, max_rt = min_rt[groups], max_rt[groups]
+    range_rt = max_rt - min_rt
+
+    nrm = np.where(range_rt == 0, 0.0, (rel - min_rt) / np.where(range_rt == 0, 1, range_rt))
+    prec = precision(rel, min_rt, max_rt)
+
+    df["RelTime"] = rel.round(2)
+    df["NrmRelTime"] = nrm
+    df["Prec"] = prec
+    df["PK"] = batched_pk(nrm, prec, groups, grid_size=grid_size, workers=workers)
+    metric_cols = ["NrmRelTime", "Prec", "PK"]
+    df[metric_cols] = df[metric_cols].round(2).astype(np.float32)
+    df.attrs["pk_refit"] = refit_state(metric_values(df, "NrmRelTime"), groups, dafsa.n_transitions, grid_size)
+    return df
+
+def release_window(task):
+    # Annotation, filtering and anonymization of one window, with a report of them
+    df, delta, condition_number, months_shift, days_shift, seed, deterministic_ids, grid_size = task
+    start = time.perf_counter()
+
+    df = window_table(df, grid_size)
+    df_filtered = DAFSA_filtrated(df, delta, condition_number, grid_size=grid_size)
+    n_cases = df["CaseID"].nunique()
+    kept_cases = df_filtered["CaseID"].nunique()
+    report = {
+        "events": len(df),
+        "cases": n_cases,
+        "events_removed": len(df) - len(df_filtered),
+        "cases_removed": n_cases - kept_cases,
+    }
+    del df
+
+    df_final = anonymize(df_filtered, months_shift, days_shift, seed, deterministic_ids)
+    report.update({
+        "output_events": len(df_final),
+        "output_cases": df_final["CaseID"].nunique(),
+        "seconds": round(time.perf_counter() - start, 3),
+    })
+    df_final.attrs["release"] = report
+    return df_final
+
+def windowed_releases(df_annotated, freq=WINDOW_FREQ, delta=0.3, condition_number=1, months_shift=0, days_shift=0, seed=None, deterministic_ids=False, processes=1, grid_size=GRID_SIZE):
+    # Generator of the anonymized release of every window of an annotated table, as
+    # (period, table) in time order, each as soon as it is done so that the caller
+    # can write it before the next. The i-th window draws from the i-th child of
+    # seed's streams, whatever process runs it.
+    streams = random_streams(seed)
+    windows = split_windows(df_annotated, freq)
+    tasks = [
+        (df, delta, condition_number, months_shift, days_shift, streams.child(i), deterministic_ids, grid_size)
+        for i, (_, df) in enumerate(windows)
+    ]
+    periods = [str(period) for period, _ in windows]
+    del windows
+
+    processes = min(processes, len(tasks))
+    if processes > 1:
+        with ProcessPoolExecutor(processes) as pool:
+            yield from zip(periods, pool.map(release_window, tasks))
+    else:
+        for period, task in zip(periods, tasks):
+            yield period, release_window(task)
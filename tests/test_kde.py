@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+
+from dp_sequential_events.main.annotated import estimate_pk
+from dp_sequential_events.main.kde import GRID_SIZE, NARROW_STEPS, fit_pk, refit_state
+
+def reference_pk(t, prec, groups):
+    # estimate_pk (one gaussian_kde per group), NaN for the fallback groups
+    df = pd.DataFrame({"NrmRelTime": t, "Prec": prec, "Group": groups})
+    pk = np.full(len(t), np.nan)
+    for g, rows in df.groupby("Group").indices.items():
+        values = estimate_pk(df.iloc[rows].copy(), delta=2.0)["PK"].to_numpy(np.float64)
+        pk[rows] = np.where(values == (1 - 2.0) / 2, np.nan, values)
+    return pk
+
+def test_matches_gaussian_kde_on_mixed_groups():
+    rng = np.random.default_rng(0)
+    t = np.concatenate([
+        rng.uniform(0, 1, 400),
+        rng.beta(2, 8, 300),
+        np.concatenate([rng.normal(0.2, 0.03, 150), rng.normal(0.8, 0.05, 150)]).clip(0, 1),
+        np.full(50, 0.4),
+        rng.uniform(0, 1, 3),
+    ])
+    groups = np.repeat(np.arange(5), [400, 300, 300, 50, 3])
+    prec = rng.choice([0.001, 0.01, 0.05, 0.2], len(t))
+
+    pk = fit_pk(t, prec, groups)
+    ref = reference_pk(t, prec, groups)
+    assert np.array_equal(np.isnan(pk), np.isnan(ref))
+    assert np.nanmax(np.abs(pk - ref)) < 3e-4
+
+def test_matches_gaussian_kde_below_a_few_grid_steps():
+    # A tight cluster with one outlier at each end: the Scott bandwidth is under two
+    # grid steps, where linear binning is off by 7e-3
+    rng = np.random.default_rng(1)
+    t = np.clip(0.5 + rng.normal(0, 1e-4, 3000), 0, 1)
+    t[0], t[1] = 0, 1
+    prec = np.full(len(t), 0.01)
+    groups = np.zeros(len(t), dtype=np.int64)
+
+    bandwidth = np.std(t, ddof=1) * len(t) ** -0.2
+    assert bandwidth * (GRID_SIZE - 1) < NARROW_STEPS
+
+    pk = fit_pk(t, prec, groups)
+    ref = reference_pk(t, prec, groups)
+    assert np.abs(pk - ref).max() < 1e-7
+    assert np.array_equal(pk.round(2), ref.round(2))
+
+    # The chunked state filtering reuses gives the same values
+    state = refit_state(t, groups, 1)
+    assert np.array_equal(state.pk(t, prec, groups), pk)
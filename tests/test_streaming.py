@@ -0,0 +1,28 @@
+import os
+
+import pandas as pd
+
+from dp_sequential_events.main.main import sampling_and_anonymization_partitions
+from dp_sequential_events.main.streaming import DAFSA_annotated_partitions, DAFSA_filtrated_partitions, Partitions
+
+DATABASES = os.path.join(os.path.dirname(__file__), "..", "src", "dp_sequential_events", "databases")
+
+def test_out_of_core_with_every_event_filtered(tmp_path):
+    annotated = DAFSA_annotated_partitions(os.path.join(DATABASES, "synthetic_data_reg2.csv"), str(tmp_path), memory_budget=100_000)
+    filtered = DAFSA_filtrated_partitions(annotated, delta=0.3, condition_number=0)
+    assert len(filtered) > 1 and filtered.meta["n_events"] == 0
+
+    final = sampling_and_anonymization_partitions(filtered, seed=0)
+    path = str(tmp_path / "final.csv")
+    final.to_file(path)
+    assert list(pd.read_csv(path).columns) == ["CaseID", "Activity", "Timestamp"]
+    assert len(pd.read_csv(path)) == 0
+
+def test_out_of_core_without_partitions(tmp_path):
+    parts = Partitions.create(str(tmp_path / "filtered"), 0, {"local_variants": [], "n_variants": 0})
+
+    final = sampling_and_anonymization_partitions(parts, seed=0)
+    path = str(tmp_path / "final.csv")
+    final.to_file(path)
+    assert list(pd.read_csv(path).columns) == ["CaseID", "Activity", "Timestamp"]
+    assert len(pd.read_csv(path)) == 0
@@ -0,0 +1,22 @@
+import pandas as pd
+
+from dp_sequential_events.main.variants import VariantIndex
+
+def test_of_rebuilds_after_relabelling_activities():
+    df = pd.DataFrame({
+        "CaseID": ["a", "a", "b", "b", "b"],
+        "Activity": pd.Categorical(["X", "Y", "X", "Y", "Z"]),
+    })
+    df.attrs["variant_index"] = index = VariantIndex.from_log(df)
+    assert VariantIndex.of(df) is index
+
+    # Same case lengths, one activity relabelled in place
+    df.loc[4, "Activity"] = "X"
+    fresh = VariantIndex.of(df)
+    assert fresh is not index
+    assert fresh.sequences() == [("X", "Y"), ("X", "Y", "X")]
+
+def test_of_reuses_the_index_of_an_empty_frame():
+    df = pd.DataFrame({"CaseID": pd.Series(dtype=str), "Activity": pd.Series(dtype=str)})
+    df.attrs["variant_index"] = index = VariantIndex.from_log(df)
+    assert VariantIndex.of(df) is index